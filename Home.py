@@ -7,6 +7,7 @@ import streamlit as st
 from mangoleaf import frontend
 
 frontend.add_config()
+frontend.add_metrics_view()
 frontend.add_style()
 frontend.add_sidebar_login()
 frontend.add_sidebar_logo()
@@ -0,0 +1,414 @@
+"""
+Benchmark the recommenders on synthetic ratings
+
+Every recommender runs on seeded synthetic ratings of increasing size in
+memory, without a database. The ratings of each size are generated once
+in a separate process and stored in a temporary file. Each case loads
+them in a fresh process, which reports the wall time, the memory used
+by the recommender on top of the loaded ratings and the throughput of
+the recommender. The results are written as a JSON report, which can be
+compared against an earlier report to catch scaling regressions.
+"""
+
+import argparse
+from datetime import datetime, timezone
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from mangoleaf import recommend
+from mangoleaf.ratings import RatingsStore
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1M": 1_000_000, "10M": 10_000_000}
+RECOMMENDERS = ["popularity", "item_based", "user_based"]
+ENGINES = ["native", "surprise"]
+
+
+def synthetic_ratings(n_ratings, seed=0, user_exponent=0.8, item_exponent=1.0):
+    """
+    Generate ratings with power-law user and item activity
+
+    Users and items are drawn with probabilities that decay with a power
+    of their rank, so that few users rate a lot and few items receive
+    most ratings, as in the real datasets. Ratings are drawn around a
+    user and an item bias.
+
+    Parameters
+    ----------
+    n_ratings : int
+        Number of distinct (user, item) ratings
+
+    seed : int, optional
+        Seed of the random generator. Default is 0
+
+    user_exponent, item_exponent : float, optional
+        Exponents of the power laws of the user and the item activity.
+        Default is 0.8 and 1.0
+
+    Returns
+    -------
+    ratings : RatingsStore
+        Synthetic ratings with integer user_ids and item_ids
+
+    catalog : pd.DataFrame
+        Items with the columns item_id and author
+    """
+    rng = np.random.default_rng(seed)
+    n_users = max(n_ratings // 20, 100)
+    n_items = max(int(3 * np.sqrt(n_ratings)), 100)
+    user_p = np.arange(1, n_users + 1) ** -user_exponent
+    item_p = np.arange(1, n_items + 1) ** -item_exponent
+    user_p /= user_p.sum()
+    item_p /= item_p.sum()
+
+    # Draw pairs until there are enough distinct ones
+    keys = np.zeros(0, dtype=np.int64)
+    while len(keys) < n_ratings:
+        size = int((n_ratings - len(keys)) * 1.5) + 1
+        users = rng.choice(n_users, size, p=user_p)
+        items = rng.choice(n_items, size, p=item_p)
+        keys = np.union1d(keys, users.astype(np.int64) * n_items + items)
+    keys = rng.choice(keys, n_ratings, replace=False)
+    user_index, item_index = np.divmod(keys, n_items)
+
+    user_bias = rng.normal(0, 0.5, n_users)
+    item_bias = rng.normal(0, 0.5, n_items)
+    noise = rng.normal(0, 1, n_ratings)
+    ratings = np.clip(np.rint(3.5 + user_bias[user_index] + item_bias[item_index] + noise), 1, 5)
+
+    # Shuffle the ids so that the inner order does not follow the activity
+    user_ids = rng.permutation(n_users) + 1
+    item_ids = rng.permutation(n_items) + 1
+    store = RatingsStore.from_indices(user_ids, item_ids, user_index, item_index, ratings)
+    catalog = pd.DataFrame(dict(item_id=item_ids, author=np.arange(n_items) // 3))
+    return store, catalog
+
+
+def peak_rss():
+    """Peak resident memory of the current process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def generate(size, seed, path):
+    """
+    Generate synthetic ratings and store them in a file
+
+    Parameters
+    ----------
+    size : str
+        Key of the number of ratings in SIZES
+
+    seed : int
+        Seed of the random generator
+
+    path : str
+        File to write, a NumPy archive
+
+    Returns
+    -------
+    result : dict
+        Status and time to generate the ratings
+    """
+    start = time.perf_counter()
+    ratings, catalog = synthetic_ratings(SIZES[size], seed)
+    generated = time.perf_counter() - start
+    np.savez(
+        path,
+        user_ids=ratings.user_ids.to_numpy(),
+        item_ids=ratings.item_ids.to_numpy(),
+        indptr=ratings.indptr,
+        item_index=ratings.item_index,
+        ratings=ratings.ratings,
+        author=catalog.author.to_numpy(),
+    )
+    return dict(status="ok", generate_time=round(generated, 3))
+
+
+def load(path):
+    """Load ratings and catalog stored by generate"""
+    with np.load(path) as archive:
+        arrays = {name: archive[name] for name in archive.files}
+    catalog = pd.DataFrame(dict(item_id=arrays["item_ids"], author=arrays.pop("author")))
+    return RatingsStore(**arrays), catalog
+
+
+def run_case(case, path):
+    """
+    Run one recommender on stored synthetic ratings and measure it
+
+    The ratings are generated in another process, so the peak memory of
+    this process is that of the loaded ratings and the recommender.
+
+    Parameters
+    ----------
+    case : dict
+        Benchmark case with the keys recommender, engine, size, seed,
+        n, users and block_size
+
+    path : str
+        File of the ratings of the case, see generate
+
+    Returns
+    -------
+    result : dict
+        The case with its measurements
+    """
+    ratings, catalog = load(path)
+    rss_data = peak_rss()
+
+    n = case["n"]
+    start = time.perf_counter()
+    if case["recommender"] == "popularity":
+        recommend.popularity("mangas", n, ratings=ratings, catalog=catalog)
+        scored = ratings.n_items
+    elif case["recommender"] == "item_based":
+        df = recommend.item_based("mangas", n, case["engine"], case["block_size"], ratings=ratings)
+        scored = len(df)
+    else:
+        rng = np.random.default_rng(case["seed"])
+        users = rng.choice(ratings.user_ids, min(case["users"], ratings.n_users), replace=False)
+        df = recommend.user_based(
+            "mangas", users.tolist(), n, case["engine"], case["block_size"], ratings=ratings
+        )
+        scored = len(users)
+    wall_time = time.perf_counter() - start
+    peak = peak_rss()
+
+    return dict(
+        case,
+        status="ok",
+        n_ratings=len(ratings),
+        n_users=ratings.n_users,
+        n_items=ratings.n_items,
+        wall_time=round(wall_time, 3),
+        scored=scored,
+        throughput=round(scored / wall_time, 1) if wall_time > 0 else None,
+        rss_data_mb=round(rss_data, 1),
+        peak_rss_mb=round(peak, 1),
+        recommender_rss_mb=round(peak - rss_data, 1),
+    )
+
+
+def _call(sender, function, *args):
+    """Entry point of a benchmark process, sends the result to the parent"""
+    try:
+        result = function(*args)
+    except Exception as e:
+        result = dict(status="error", error=f"{type(e).__name__}: {e}")
+    sender.send(result)
+    sender.close()
+
+
+def _in_process(function, *args, timeout=3600):
+    """
+    Run a function in a fresh process
+
+    Returns
+    -------
+    result : dict
+        Result of the function. The status is "timeout" or "failed" if
+        the process did not finish, e.g. if it ran out of memory
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_call, args=(sender, function, *args))
+    process.start()
+    sender.close()
+
+    result = dict(status="timeout")
+    if receiver.poll(timeout):
+        try:
+            result = receiver.recv()
+        except EOFError:
+            process.join()
+            result = dict(status="failed", exitcode=process.exitcode)
+    process.terminate()
+    process.join()
+    return result
+
+
+def measure(case, directory, timeout=3600):
+    """
+    Run a benchmark case in a fresh process
+
+    A fresh process per case keeps the peak memory of one case from
+    hiding that of the next. The ratings of a size and seed are
+    generated in their own process on first use and stored in the
+    directory for the following cases.
+
+    Parameters
+    ----------
+    case : dict
+        Benchmark case, see run_case
+
+    directory : str
+        Directory of the stored ratings
+
+    timeout : float, optional
+        Seconds after which the generation or the case is aborted.
+        Default is 3600
+
+    Returns
+    -------
+    result : dict
+        The case with its measurements. The status is "timeout" or
+        "failed" if the process did not finish, e.g. if it ran out of
+        memory
+    """
+    path = os.path.join(directory, f"{case['size']}_{case['seed']}.npz")
+    generated = _generated.get(path)
+    if generated is None:
+        generated = _in_process(generate, case["size"], case["seed"], path, timeout=timeout)
+        _generated[path] = generated
+    if generated["status"] != "ok":
+        return dict(case, **generated)
+    result = dict(case, **_in_process(run_case, case, path, timeout=timeout))
+    result["generate_time"] = generated["generate_time"]
+    return result
+
+
+# Generation results by the file of the ratings
+_generated = dict()
+
+
+def cases(sizes, recommenders, engines, seed=0, n=40, users=1000, block_size=1024):
+    """List the benchmark cases, popularity has only one engine"""
+    for size in sizes:
+        for recommender in recommenders:
+            for engine in [None] if recommender == "popularity" else engines:
+                yield dict(
+                    recommender=recommender,
+                    engine=engine,
+                    size=size,
+                    seed=seed,
+                    n=n,
+                    users=users,
+                    block_size=block_size,
+                )
+
+
+def compare(results, baseline, tolerance=1.2):
+    """
+    Find cases that became slower or larger than in an earlier report
+
+    Parameters
+    ----------
+    results : list of dict
+        Results of the current run
+
+    baseline : list of dict
+        Results of an earlier run
+
+    tolerance : float, optional
+        Factor by which the wall time or the memory of the recommender
+        may grow. Default is 1.2
+
+    Returns
+    -------
+    regressions : list of str
+        Description of each regression
+    """
+    keys = ["recommender", "engine", "size"]
+    previous = {tuple(r[key] for key in keys): r for r in baseline if r["status"] == "ok"}
+    regressions = []
+    for result in results:
+        before = previous.get(tuple(result[key] for key in keys))
+        if before is None:
+            continue
+        name = "/".join(str(result[key]) for key in keys)
+        if result["status"] != "ok":
+            regressions.append(f"{name}: {result['status']}")
+            continue
+        for metric in ["wall_time", "recommender_rss_mb"]:
+            if metric in before and result[metric] > before[metric] * tolerance:
+                regressions.append(f"{name}: {metric} {before[metric]} -> {result[metric]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", nargs="+", choices=list(SIZES), default=list(SIZES), help="Numbers of ratings"
+    )
+    parser.add_argument("--recommenders", nargs="+", choices=RECOMMENDERS, default=RECOMMENDERS)
+    parser.add_argument(
+        "--engines", nargs="+", choices=ENGINES, default=ENGINES, help="k-NN engines to compare"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the ratings (default: 0)")
+    parser.add_argument(
+        "--users",
+        type=int,
+        default=1000,
+        help="Number of users to score with user_based (default: 1000)",
+    )
+    parser.add_argument(
+        "--block-size", type=int, default=1024, help="Block size of the native engine"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=3600, help="Seconds per case (default: 3600)"
+    )
+    parser.add_argument("--output", help="File to write the report to (default: stdout)")
+    parser.add_argument("--baseline", help="Earlier report to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.2,
+        help="Allowed growth of wall time and recommender memory over the baseline (default: 1.2)",
+    )
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for case in cases(
+            args.sizes, args.recommenders, args.engines, args.seed, 40, args.users, args.block_size
+        ):
+            name = f"{case['recommender']}/{case['engine']}/{case['size']}"
+            print(f"Benchmark {name}", file=sys.stderr)
+            result = measure(case, directory, args.timeout)
+            if result["status"] == "ok":
+                print(
+                    f"  {result['wall_time']} s, {result['recommender_rss_mb']} MB, "
+                    f"{result['throughput']} per s",
+                    file=sys.stderr,
+                )
+            else:
+                print(f"  {result['status']} {result.get('error', '')}", file=sys.stderr)
+            results.append(result)
+
+    report = dict(
+        created=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+        numpy=np.__version__,
+        pandas=pd.__version__,
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression {regression}", file=sys.stderr)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
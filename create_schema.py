@@ -36,8 +36,14 @@ def main():
     print("Load data from disk")
     books = pd.read_csv("data/books/clean/books.csv", dtype="object")
     mangas = pd.read_csv("data/mangas/clean/mangas.csv", dtype="object")
-    books_ratings = pd.read_csv("data/books/clean/ratings.csv", dtype="object")
-    mangas_ratings = pd.read_csv("data/mangas/clean/ratings.csv", dtype="object")
+    books_ratings = pd.read_csv(
+        "data/books/clean/ratings.csv",
+        dtype={"User-ID": "int32", "ISBN": "string", "Book-Rating": "int8"},
+    )
+    mangas_ratings = pd.read_csv(
+        "data/mangas/clean/ratings.csv",
+        dtype={"user_id": "int32", "anime_id": "int32", "rating": "int8"},
+    )
 
     # Fill the static data: Books
     print("Fill static data")
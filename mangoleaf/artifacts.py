@@ -0,0 +1,492 @@
+"""
+Persist fitted recommender models between runs
+
+A fitted model holds the baselines, the nearest neighbors of all users
+and items and the mapping between raw and inner ids of one dataset.
+Models are stored on disk keyed by the dataset and a checksum of its
+ratings table, so a model is only refitted when the ratings changed.
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sqlalchemy.sql import text
+
+from mangoleaf import Connection, knn
+from mangoleaf.ratings import RatingsStore
+
+
+class Model:
+    """
+    Baseline k-NN model of one dataset
+
+    Attributes
+    ----------
+    dataset : str
+        Name of the dataset the model was fitted on
+
+    checksum : str
+        Checksum of the ratings the model was fitted on
+
+    k : int
+        Number of neighbors per user and per item
+
+    user_ids : pd.Index
+        Raw user_ids by inner user index
+
+    item_ids : pd.Index
+        Raw item_ids by inner item index
+
+    matrix : sp.csr_matrix
+        Ratings with users as rows and items as columns
+
+    global_mean, bu, bi : float, np.ndarray, np.ndarray
+        Baseline estimates
+
+    user_neighbors, user_similarities : np.ndarray
+        Nearest neighbors of each user, see knn.neighbors
+
+    item_neighbors, item_similarities : np.ndarray
+        Nearest neighbors of each item, see knn.neighbors
+
+    recomputed_items : list
+        Raw item_ids whose neighbors were recomputed by Model.update
+    """
+
+    arrays = [
+        "bu",
+        "bi",
+        "user_neighbors",
+        "user_similarities",
+        "item_neighbors",
+        "item_similarities",
+    ]
+
+    def __init__(self, dataset, checksum, k, user_ids, item_ids, matrix, **arrays):
+        self.dataset = dataset
+        self.checksum = checksum
+        self.k = k
+        self.user_ids = pd.Index(user_ids)
+        self.item_ids = pd.Index(item_ids)
+        self.matrix = matrix
+        self.global_mean = float(arrays.pop("global_mean"))
+        self.recomputed_items = arrays.pop("recomputed_items", [])
+        for name in self.arrays:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def fit(cls, dataset, ratings, checksum=None, k=40, block_size=1024):
+        """
+        Fit the model on the ratings of a dataset
+
+        Parameters
+        ----------
+        dataset : {"books", "mangas"}
+            Name of the dataset
+
+        ratings : RatingsStore
+            Ratings of the dataset
+
+        checksum : str, optional
+            Checksum of the ratings to store with the model
+
+        k : int, optional
+            Number of neighbors per user and per item. Default is 40
+
+        block_size : int, optional
+            Number of rows to compute the similarities for at once.
+            Default is 1024
+
+        Returns
+        -------
+        model : Model
+            Fitted model
+        """
+        matrix = ratings.to_matrix()
+
+        global_mean, bu, bi = knn.baselines(matrix)
+        residuals = knn.residuals(matrix, global_mean, bu, bi)
+        user_neighbors, user_similarities = knn.neighbors(residuals, k, block_size=block_size)
+        item_neighbors, item_similarities = knn.neighbors(
+            residuals.T.tocsr(), k, block_size=block_size
+        )
+
+        return cls(
+            dataset,
+            checksum,
+            k,
+            ratings.user_ids,
+            ratings.item_ids,
+            matrix,
+            global_mean=global_mean,
+            bu=bu,
+            bi=bi,
+            user_neighbors=user_neighbors,
+            user_similarities=user_similarities,
+            item_neighbors=item_neighbors,
+            item_similarities=item_similarities,
+        )
+
+    def update(self, ratings, users, items, checksum=None, block_size=1024):
+        """
+        Refit the model on changed ratings, reusing unaffected neighbors
+
+        The baselines are refitted on all ratings, but the neighbors are
+        recomputed only for the given users and items and for users and
+        items that are new to the model. Users and items without ratings
+        left, e.g. of deleted users, are dropped from the model, and the
+        neighbor lists that pointed at them are recomputed as well. All
+        other neighbor lists are carried over. New users and items are
+        appended to the remaining inner ids.
+
+        Parameters
+        ----------
+        ratings : RatingsStore
+            Current ratings of the dataset
+
+        users : list
+            user_ids whose ratings changed
+
+        items : list
+            item_ids whose ratings changed
+
+        checksum : str, optional
+            Checksum of the ratings to store with the model
+
+        block_size : int, optional
+            Number of rows to compute the similarities for at once.
+            Default is 1024
+
+        Returns
+        -------
+        model : Model
+            Updated model, with the item_ids whose neighbors were
+            recomputed in recomputed_items
+        """
+        user_ids = _current_ids(self.user_ids, ratings.user_ids)
+        item_ids = _current_ids(self.item_ids, ratings.item_ids)
+        user_map = user_ids.get_indexer(ratings.user_ids)
+        item_map = item_ids.get_indexer(ratings.item_ids)
+        matrix = knn.rating_matrix(
+            user_map[ratings.user_index],
+            item_map[ratings.item_index],
+            ratings.ratings,
+            len(user_ids),
+            len(item_ids),
+        )
+
+        global_mean, bu, bi = knn.baselines(matrix)
+        residuals = knn.residuals(matrix, global_mean, bu, bi)
+
+        # Recompute the neighbors of changed and new rows and of rows
+        # that lost a neighbor, carry over all others
+        neighbors = dict()
+        for kind, ids, changed, operand in [
+            ("user", user_ids, users, residuals),
+            ("item", item_ids, items, residuals.T.tocsr()),
+        ]:
+            old_indices = getattr(self, f"{kind}_neighbors")
+            old_values = getattr(self, f"{kind}_similarities")
+            kept = np.flatnonzero(getattr(self, f"{kind}_ids").isin(ids))
+
+            # Old inner index to new inner index, -1 for dropped rows and
+            # for the padding, which indexes the last entry
+            remap = np.full(len(old_indices) + 1, -1, dtype=old_indices.dtype)
+            remap[kept] = np.arange(len(kept))
+            carried = remap[old_indices[kept]]
+            lost = ((old_indices[kept] >= 0) & (carried < 0)).any(axis=1)
+
+            indices = np.full((len(ids), old_indices.shape[1]), -1, dtype=old_indices.dtype)
+            values = np.full(indices.shape, np.nan, dtype=old_values.dtype)
+            indices[: len(kept)] = carried
+            values[: len(kept)] = old_values[kept]
+
+            rows = ids.get_indexer(pd.Index(changed))
+            rows = np.union1d(rows[rows >= 0], np.arange(len(kept), len(ids)))
+            rows = np.union1d(rows, np.flatnonzero(lost))
+            indices[rows], values[rows] = knn.neighbors(
+                operand, self.k, rows=rows, block_size=block_size
+            )
+            neighbors[f"{kind}_neighbors"] = indices
+            neighbors[f"{kind}_similarities"] = values
+            if kind == "item":
+                recomputed_items = ids[rows].tolist()
+
+        return Model(
+            self.dataset,
+            checksum,
+            self.k,
+            user_ids,
+            item_ids,
+            matrix,
+            global_mean=global_mean,
+            bu=bu,
+            bi=bi,
+            recomputed_items=recomputed_items,
+            **neighbors,
+        )
+
+    def save(self, path):
+        """
+        Save the model to a compressed NumPy archive
+
+        Parameters
+        ----------
+        path : str or Path
+            File to write
+        """
+        np.savez_compressed(
+            path,
+            dataset=self.dataset,
+            checksum=self.checksum or "",
+            k=self.k,
+            user_ids=self.user_ids.to_numpy(dtype=_id_dtype(self.user_ids)),
+            item_ids=self.item_ids.to_numpy(dtype=_id_dtype(self.item_ids)),
+            data=self.matrix.data,
+            indices=self.matrix.indices,
+            indptr=self.matrix.indptr,
+            shape=self.matrix.shape,
+            global_mean=self.global_mean,
+            **{name: getattr(self, name) for name in self.arrays},
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a model saved with Model.save
+
+        Parameters
+        ----------
+        path : str or Path
+            File to read
+
+        Returns
+        -------
+        model : Model
+            Fitted model
+        """
+        with np.load(path) as archive:
+            matrix = sp.csr_matrix(
+                (archive["data"], archive["indices"], archive["indptr"]),
+                shape=tuple(archive["shape"]),
+            )
+            return cls(
+                str(archive["dataset"]),
+                str(archive["checksum"]) or None,
+                int(archive["k"]),
+                archive["user_ids"].tolist(),
+                archive["item_ids"].tolist(),
+                matrix,
+                global_mean=archive["global_mean"],
+                **{name: archive[name] for name in cls.arrays},
+            )
+
+
+def _current_ids(ids, current_ids):
+    """Keep the ids that are still current in their order and append the new ones"""
+    return ids[ids.isin(current_ids)].append(current_ids[~current_ids.isin(ids)])
+
+
+def _id_dtype(ids):
+    """Store integer ids as integers and everything else as strings"""
+    return np.int64 if pd.api.types.is_integer_dtype(ids) else str
+
+
+def ratings_checksum(dataset, connection=None):
+    """
+    Compute a checksum of a ratings table in the database
+
+    The checksum combines the number of ratings with the sum of a hash
+    of each rating, so it does not depend on the order of the rows.
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    connection : sqlalchemy.engine.Connection, optional
+        Connection to read the ratings with. Default is a new connection
+        to the primary database
+
+    Returns
+    -------
+    checksum : str
+        MD5 checksum of the number of ratings and the sum of their hashes
+    """
+    query = f"""
+    SELECT md5(count(*)::text || ',' || COALESCE(sum(hashtextextended(
+        user_id::text || ',' || item_id::text || ',' || rating::text, 0
+    )), 0)::text)
+    FROM {dataset}_ratings
+    """
+    if connection is None:
+        with Connection().get().connect() as connection:
+            return connection.execute(text(query)).scalar()
+    return connection.execute(text(query)).scalar()
+
+
+def _snapshot():
+    """Connection that reads the checksum and the ratings from one snapshot"""
+    connection = Connection().get().connect()
+    return connection.execution_options(isolation_level="REPEATABLE READ")
+
+
+def artifact_dir():
+    """
+    Directory of the stored models
+
+    Set by the environment variable MANGOLEAF_ARTIFACTS. Defaults to
+    "artifacts" in the working directory.
+
+    Returns
+    -------
+    directory : Path
+        Directory of the stored models
+    """
+    return Path(os.environ.get("MANGOLEAF_ARTIFACTS", "artifacts"))
+
+
+def model_path(dataset, checksum, k):
+    """
+    File of a stored model
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    checksum : str
+        Checksum of the ratings
+
+    k : int
+        Number of neighbors per user and per item
+
+    Returns
+    -------
+    path : Path
+        Path of the stored model
+    """
+    return artifact_dir() / f"{dataset}_{checksum}_k{k}.npz"
+
+
+def _store(model):
+    """Save a model and remove the outdated models of its dataset"""
+    directory = artifact_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    for outdated in directory.glob(f"{model.dataset}_*.npz"):
+        outdated.unlink()
+    model.save(model_path(model.dataset, model.checksum, model.k))
+
+
+def load_or_fit(dataset, k=40, block_size=1024):
+    """
+    Load the stored model of the current ratings or fit a new one
+
+    A newly fitted model replaces the stored models of the dataset.
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    k : int, optional
+        Number of neighbors per user and per item. Default is 40
+
+    block_size : int, optional
+        Number of rows to compute the similarities for at once. Default
+        is 1024
+
+    Returns
+    -------
+    model : Model
+        Fitted model of the current ratings
+    """
+    with _snapshot() as connection, connection.begin():
+        checksum = ratings_checksum(dataset, connection)
+        path = model_path(dataset, checksum, k)
+        if path.exists():
+            print(f"Reuse stored model for {dataset}")
+            return Model.load(path)
+
+        print(f"Fit model for {dataset}")
+        ratings = RatingsStore.load(dataset, connection=connection)
+    model = Model.fit(dataset, ratings, checksum, k, block_size)
+    _store(model)
+    return model
+
+
+def load_latest(dataset, k=40):
+    """
+    Load the stored model of a dataset regardless of its checksum
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    k : int, optional
+        Number of neighbors per user and per item. Default is 40
+
+    Returns
+    -------
+    model : Model or None
+        Stored model, None if there is no stored model of the dataset
+    """
+    stored = sorted(artifact_dir().glob(f"{dataset}_*_k{k}.npz"))
+    if not stored:
+        return None
+    return Model.load(stored[0])
+
+
+def load_or_update(dataset, users, items, k=40, block_size=1024):
+    """
+    Load the stored model of the current ratings or update the last one
+
+    If there is no stored model of the dataset at all, a new model is
+    fitted. The resulting model replaces the stored models of the
+    dataset.
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    users : list
+        user_ids whose ratings changed since the last stored model
+
+    items : list
+        item_ids whose ratings changed since the last stored model
+
+    k : int, optional
+        Number of neighbors per user and per item. Default is 40
+
+    block_size : int, optional
+        Number of rows to compute the similarities for at once. Default
+        is 1024
+
+    Returns
+    -------
+    model : Model
+        Fitted model of the current ratings
+    """
+    with _snapshot() as connection, connection.begin():
+        checksum = ratings_checksum(dataset, connection)
+        path = model_path(dataset, checksum, k)
+        if path.exists():
+            print(f"Reuse stored model for {dataset}")
+            return Model.load(path)
+
+        previous = load_latest(dataset, k)
+        ratings = RatingsStore.load(dataset, connection=connection)
+
+    if previous is None:
+        print(f"Fit model for {dataset}")
+        model = Model.fit(dataset, ratings, checksum, k, block_size)
+    else:
+        print(f"Update stored model for {dataset}")
+        model = previous.update(ratings, users, items, checksum, block_size)
+    _store(model)
+    return model
@@ -5,6 +5,7 @@ Authenticate user access
 import streamlit as st
 
 from mangoleaf import query
+from mangoleaf.ratings import RatedItems
 
 
 def reset():
@@ -13,6 +14,7 @@ def reset():
     st.session_state["full_name"] = None
     st.session_state["user_id"] = None
     st.session_state["registered"] = None
+    st.session_state["rated_items"] = None
     for key in st.session_state.keys():
         if key.startswith("rate_"):
             del st.session_state[key]
@@ -28,6 +30,7 @@ def authenticate(username, password):
     st.session_state["full_name"] = user_info["full_name"]
     st.session_state["user_id"] = user_info["user_id"]
     st.session_state["registered"] = user_info["registered"]
+    st.session_state["rated_items"] = RatedItems.load(user_info["user_id"])
     return True
 
 
@@ -72,5 +75,15 @@ def get_user_info():
     )
 
 
+def get_rated_items():
+    """Rated items of the logged in user, loaded once per session"""
+    rated = st.session_state.get("rated_items", None)
+    if rated is None:
+        user_id = st.session_state.get("user_id", None)
+        rated = RatedItems.load(user_id) if user_id is not None else RatedItems()
+        st.session_state["rated_items"] = rated
+    return rated
+
+
 def get_extended_user_info():
     return query.get_extended_user_info(st.session_state.get("user_id", None))
@@ -0,0 +1,204 @@
+"""
+Cache reads of the precomputed recommendations and of the catalogs
+
+The recommendation tables only change when the update job publishes new
+recommendations and bumps the recommendation version. Cached reads are
+kept until the version changes or until they are evicted as the least
+recently used. The version itself is checked at most once per time to
+live, so repeated reads do not touch the database. Misses are loaded
+from the same source, e.g. read replica, that the version was checked
+on, so that no entry is older than the version it is stored under.
+Searches of the static catalogs are kept for a time to live instead.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class VersionedCache:
+    """
+    Bounded LRU cache that is cleared when the data version changes
+
+    Parameters
+    ----------
+    version : callable
+        Function that takes a source and returns the current version of
+        the cached data in it
+
+    source : callable, optional
+        Function without arguments that picks the source to check the
+        version on and to load the misses of this version from. Default
+        is None as the only source
+
+    maxsize : int, optional
+        Maximum number of entries. Default is 4096
+
+    ttl : float, optional
+        Seconds between checks of the version. Default is 60
+    """
+
+    def __init__(self, version, source=None, maxsize=4096, ttl=60):
+        self.version = version
+        self.source = source or (lambda: None)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._current = None
+        self._source = None
+        self._checked = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _validate(self):
+        """Clear the entries if the version changed, return the version and its source"""
+        now = time.monotonic()
+        with self._lock:
+            if self._checked is not None and now - self._checked < self.ttl:
+                return self._current, self._source
+        source = self.source()
+        version = self.version(source)
+        with self._lock:
+            self._checked = now
+            if version != self._current:
+                self._entries.clear()
+                self._current = version
+            self._source = source
+            return version, source
+
+    def _put(self, key, value, version):
+        """Store an entry unless the version changed while loading it"""
+        with self._lock:
+            if version != self._current:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get(self, key, load):
+        """
+        Get an entry, loading it on a miss
+
+        Parameters
+        ----------
+        key : hashable
+            Key of the entry
+
+        load : callable
+            Function that takes the source and returns the value on a
+            miss
+
+        Returns
+        -------
+        value : object
+            Cached or loaded value
+        """
+        version, source = self._validate()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = load(source)
+        self._put(key, value, version)
+        return value
+
+    def get_many(self, keys, load):
+        """
+        Get several entries, loading all misses at once
+
+        Parameters
+        ----------
+        keys : list
+            Keys of the entries
+
+        load : callable
+            Function that takes the list of missed keys and the source
+            and returns a dict with a value for each of them
+
+        Returns
+        -------
+        values : dict
+            Cached or loaded value by key
+        """
+        version, source = self._validate()
+        values = dict()
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    values[key] = self._entries[key]
+        missing = [key for key in keys if key not in values]
+        if missing:
+            loaded = load(missing, source)
+            for key in missing:
+                self._put(key, loaded[key], version)
+            values.update(loaded)
+        return values
+
+    def clear(self):
+        """Remove all entries and check the version on the next read"""
+        with self._lock:
+            self._entries.clear()
+            self._checked = None
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire after a time to live
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of entries. Default is 1024
+
+    ttl : float, optional
+        Seconds that an entry is kept. Default is 300
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, load):
+        """
+        Get an entry, loading it on a miss or after it expired
+
+        Parameters
+        ----------
+        key : hashable
+            Key of the entry
+
+        load : callable
+            Function without arguments that returns the value on a miss
+
+        Returns
+        -------
+        value : object
+            Cached or loaded value
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+        value = load()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,118 @@
+"""
+Keep the static item catalogs in memory
+
+The books and mangas tables do not change while the app is running.
+Each process loads a catalog once on first use into column arrays with
+an index from item_id to row, so that queries only need to fetch the
+item_ids from the database.
+"""
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+from mangoleaf import Connection
+
+_catalogs = dict()
+_lock = threading.Lock()
+
+
+class Catalog:
+    """
+    Items of one dataset in column arrays
+
+    Attributes
+    ----------
+    columns : list of str
+        Column names in the order of the table
+
+    index : pd.Index
+        item_ids by row, to look up the rows of item_ids
+
+    arrays : dict
+        Values of each column by row. Text columns with many repeated
+        values, like authors or genres, are stored as categoricals
+    """
+
+    def __init__(self, df):
+        self.columns = list(df.columns)
+        self.index = pd.Index(df.item_id)
+        self.arrays = dict()
+        for column in self.columns:
+            values = df[column]
+            if pd.api.types.is_string_dtype(values) and values.nunique() < len(values) // 2:
+                self.arrays[column] = pd.Categorical(values)
+            else:
+                self.arrays[column] = values.to_numpy()
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_items(self, ids):
+        """
+        Look up items by their item_ids
+
+        Parameters
+        ----------
+        ids : list-like
+            item_ids to look up
+
+        Returns
+        -------
+        df : pd.DataFrame
+            Items in the order of ids with the columns of the table.
+            Unknown item_ids are left out
+        """
+        rows = self.index.get_indexer(pd.Index(ids))
+        rows = rows[rows >= 0]
+        df = pd.DataFrame(
+            {column: np.asarray(self.arrays[column][rows]) for column in self.columns}
+        )
+        return df
+
+
+def get_catalog(dataset):
+    """
+    Get the catalog of a dataset, loading it on first use
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    Returns
+    -------
+    catalog : Catalog
+        Items of the dataset
+    """
+    catalog = _catalogs.get(dataset)
+    if catalog is None:
+        with _lock:
+            catalog = _catalogs.get(dataset)
+            if catalog is None:
+                query = f"SELECT * FROM {dataset} ORDER BY item_id"
+                catalog = Catalog(pd.read_sql(query, Connection().get_reader()))
+                _catalogs[dataset] = catalog
+    return catalog
+
+
+def get_items(dataset, ids):
+    """
+    Look up items of a dataset by their item_ids
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    ids : list-like
+        item_ids to look up
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Items in the order of ids with the columns of the table. Unknown
+        item_ids are left out
+    """
+    return get_catalog(dataset).get_items(ids)
@@ -2,56 +2,160 @@
 Establish a connection to the database
 """
 
+import itertools
 import os
+import threading
 
+import numpy as np
+from psycopg2.extensions import AsIs, register_adapter
 from sqlalchemy import create_engine
-from sqlalchemy.pool import QueuePool
+
+from mangoleaf.metrics import TimedQueuePool, instrument_engine
+
+# Allow NumPy scalars, e.g. from DataFrame rows, as query parameters
+for numpy_type in [np.int32, np.int64, np.float64]:
+    register_adapter(numpy_type, AsIs)
 
 
 def singleton(class_):
     """Source: https://stackoverflow.com/questions/6760685"""
     instances = {}
+    lock = threading.Lock()
 
     def getinstance(*args, **kwargs):
-        if class_ not in instances or kwargs.pop("force_new_instance", False):
-            instances[class_] = class_(*args, **kwargs)
+        # Threads that hydrate rows concurrently may ask for the first instance at once
+        with lock:
+            if class_ not in instances or kwargs.pop("force_new_instance", False):
+                instances[class_] = class_(*args, **kwargs)
         return instances[class_]
 
+    getinstance.instances = instances
     return getinstance
 
 
+def _setting(name, default, cast=int):
+    """Read a setting from the environment, the default if it is not set"""
+    value = os.environ.get(name, "")
+    return cast(value) if value.strip() else default
+
+
 @singleton
 class Connection:
     def __init__(self):
-        """Establish a connection to the Postgress database"""
+        """
+        Establish the connections to the Postgress database
+
+        The primary database takes all writes. Read replicas are given
+        as a comma-separated list of hosts in POSTGRES_REPLICA_HOSTS.
+        The pool of each engine is configured with POSTGRES_POOL_SIZE,
+        POSTGRES_MAX_OVERFLOW, POSTGRES_POOL_TIMEOUT (seconds) and
+        POSTGRES_POOL_RECYCLE (seconds).
+        """
         print("Establishing a connection to the database")
 
-        self.connection_string = "{protocol}://{user}:{password}@{host}/{database}?{query}".format(
+        self.pool_settings = dict(
+            pool_size=_setting("POSTGRES_POOL_SIZE", 10),
+            max_overflow=_setting("POSTGRES_MAX_OVERFLOW", 20),
+            pool_timeout=_setting("POSTGRES_POOL_TIMEOUT", 30, float),
+            pool_recycle=_setting("POSTGRES_POOL_RECYCLE", 1800),
+        )
+        self.engines = dict()
+        self.replicas = []
+        self._next_replica = itertools.count()
+
+        self.add_engine("primary", os.environ.get("POSTGRES_HOST"))
+        replica_hosts = os.environ.get("POSTGRES_REPLICA_HOSTS", "").split(",")
+        for host in filter(None, map(str.strip, replica_hosts)):
+            self.add_engine(f"replica_{len(self.replicas)}", host, replica=True)
+
+    def add_engine(self, name, host, replica=False, **pool_settings):
+        """
+        Add a named engine to a database host
+
+        Parameters
+        ----------
+        name : str
+            Name of the engine
+
+        host : str
+            Host of the database
+
+        replica : bool, optional
+            Whether the host is a read replica to route reads to.
+            Default is False
+
+        **pool_settings
+            Settings of the connection pool that differ from the
+            configured ones, e.g. pool_size
+        """
+        connection_string = "{protocol}://{user}:{password}@{host}/{database}?{query}".format(
             protocol="postgresql+psycopg2",
             user=os.environ.get("POSTGRES_USER"),
             password=os.environ.get("POSTGRES_PASSWORD"),
-            host=os.environ.get("POSTGRES_HOST"),
+            host=host,
             database=os.environ.get("POSTGRES_DB"),
-            query="sslmode=require",
+            query="sslmode=" + os.environ.get("POSTGRES_SSLMODE", "require"),
         )
 
-        self.engine = create_engine(
-            self.connection_string,
-            poolclass=QueuePool,
-            pool_size=10,
-            max_overflow=20,
-            pool_timeout=30,
-            pool_recycle=1800,
+        self.engines[name] = create_engine(
+            connection_string,
+            poolclass=TimedQueuePool,
+            pool_logging_name=name,
             pool_pre_ping=True,
+            **dict(self.pool_settings, **pool_settings),
         )
+        instrument_engine(self.engines[name], name)
+        if replica:
+            self.replicas.append(name)
 
-    def get(self):
+    def get(self, name="primary"):
         """
         Get the connection to the database
 
+        Parameters
+        ----------
+        name : str, optional
+            Name of the engine. Default is "primary"
+
         Returns
         -------
         sqlalchemy.engine.base.Engine
             Connection to the database
         """
-        return self.engine
+        return self.engines[name]
+
+    def get_reader(self):
+        """
+        Get a connection for reads that tolerate replication lag
+
+        The read replicas take turns. Without replicas, reads go to the
+        primary database.
+
+        Returns
+        -------
+        sqlalchemy.engine.base.Engine
+            Connection to a read replica or to the primary database
+        """
+        if not self.replicas:
+            return self.engines["primary"]
+        name = self.replicas[next(self._next_replica) % len(self.replicas)]
+        return self.engines[name]
+
+    def reset_after_fork(self):
+        """
+        Discard the pooled connections inherited from the parent process
+
+        The connections are not closed, because their sockets are still
+        in use by the parent. New connections are opened on demand.
+        """
+        for engine in self.engines.values():
+            engine.dispose(close=False)
+
+
+def _reset_after_fork():
+    """Make the Connection singleton safe to use in forked processes"""
+    for instance in Connection.instances.values():
+        instance.reset_after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -3,14 +3,20 @@ Functionality for the frontend of repeated tasks
 """
 
 import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
+import hmac
 import io
+import os
 import re
 
 import pandas as pd
 import streamlit as st
+import streamlit.components.v1 as components
 from PIL import Image
+from sqlalchemy.exc import SQLAlchemyError
 
-from mangoleaf import authentication, query
+from mangoleaf import authentication, metrics, query, search
 
 tv_keywords = re.compile(
     r"(\s*(00)?\:?\s*(the)?\s*(final|second|first|third)?\s*season"
@@ -20,6 +26,44 @@ tv_keywords = re.compile(
     re.IGNORECASE,
 )
 
+placeholder_element = """<div class="rec_element rec_element_empty">
+    <div></div>
+</div>"""
+
+# Explorer grid with star ratings, see components/explorer_grid
+_explorer_grid = components.declare_component(
+    "explorer_grid", path=os.path.join(os.path.dirname(__file__), "components", "explorer_grid")
+)
+
+# Threads to run the queries of independent rows concurrently
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hydrate")
+
+
+def hydrate_rows(tasks, concurrent=True):
+    """
+    Load the content of several rows and render each as it arrives
+
+    Parameters
+    ----------
+    tasks : list of tuple
+        Pairs of functions (load, render) per row. load takes no
+        arguments and only queries the database, so that it can run on
+        a worker thread. render takes the result of load and draws the
+        row in the script thread
+
+    concurrent : bool, optional
+        Whether to run the loads concurrently. Otherwise the rows are
+        loaded and rendered one after another. Default is True
+    """
+    if not concurrent:
+        for load, render in tasks:
+            render(load())
+        return
+
+    futures = {_executor.submit(load): render for load, render in tasks}
+    for future in as_completed(futures):
+        futures[future](future.result())
+
 
 def add_config():
     st.set_page_config(
@@ -34,6 +78,25 @@ def add_style():
         st.html(f"<style>{f.read()}</style>")
 
 
+def add_metrics_view():
+    """
+    Show the metrics of the app process instead of the page
+
+    The view is hidden unless the page is opened with the query
+    parameter ?metrics= set to the METRICS_TOKEN environment variable.
+    """
+    token = os.environ.get("METRICS_TOKEN", "")
+    given = st.query_params.get("metrics", "")
+    # Compare bytes, strings with non-ASCII characters are not supported
+    if not token or not hmac.compare_digest(given.encode(), token.encode()):
+        return
+
+    text = metrics.prometheus_text()
+    st.download_button("Download metrics", text, "metrics.txt", "text/plain")
+    st.code(text, language=None)
+    st.stop()
+
+
 def add_header_logo(header):
     col1, col2 = st.columns([1, 7])
     col1.image("images/mango_logo.png", width=130)
@@ -76,21 +139,81 @@ def add_row_header(heading, context=st):
     context.html(f"<h2 class='row_header'>{heading}</h2>")  # Allow coloring
 
 
-def make_row_placeholder(n, context=st, skip=None):
+def _escape(values):
+    """Escape text values for HTML, all at once"""
+    values = values.fillna("").astype(str)
+    for character, entity in [("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ('"', "&quot;")]:
+        values = values.str.replace(character, entity, regex=False)
+    return values
+
+
+def rec_elements(df, link=True):
+    """
+    Build the HTML of the recommendation elements of all items at once
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Items with the columns item_id, title and image, and the
+        secondary information in the third column
+
+    link : bool, optional
+        Whether to link the elements to the item pages. Default is True
+
+    Returns
+    -------
+    elements : pd.Series
+        HTML of the element of each item
+    """
+    content = (
+        '<img src="'
+        + _escape(df["image"])
+        + '" alt="" class="rec_image"><div class="rec_text"><p></p><p>'
+        + _escape(df["title"])
+        + "</p><p>"
+        + _escape(df.iloc[:, 2])
+        + "</p></div>"
+    )
+    if link:
+        if "author" in df.columns:
+            url = "https://isbnsearch.org/isbn/"
+        else:
+            url = "https://myanimelist.net/anime/"
+        content = (
+            f'<a href="{url}'
+            + _escape(df["item_id"])
+            + '" rel="noopener noreferrer" target="_blank">'
+            + content
+            + "</a>"
+        )
+    return '<div class="rec_element">' + content + "</div>"
+
+
+def row_html(elements, n):
+    """HTML of a row of n equally wide cells filled with the elements"""
+    cells = "".join(list(elements)[:n])
+    return f'<div class="rec_row" style="--columns: {n};">{cells}</div>'
+
+
+def make_row_placeholder(n, context=st, skip=None, grid=True):
+    if grid and skip is None:
+        context.html(row_html([placeholder_element] * n, n))
+        return
+
     columns = context.columns(n)
     for i, col in enumerate(columns):
         if i == skip:
             continue
         with col:
-            st.markdown(
-                """<div class="rec_element rec_element_empty">
-                    <div></div>
-                </div>""",
-                unsafe_allow_html=True,
-            )
+            st.markdown(placeholder_element, unsafe_allow_html=True)
+
 
+def make_row(df, n, context=st, grid=True):
+    if grid:
+        # One payload for the whole row instead of one per column
+        context.html(row_html(rec_elements(df.head(n)), n))
+        return
 
-def make_row(df, n, context=st):
     if "author" in df.columns:
         url = "https://isbnsearch.org/isbn/"
     else:
@@ -126,9 +249,10 @@ def make_row(df, n, context=st):
             )
 
 
-def add_recommendations(dataset, user_id, n):
+def add_recommendations(dataset, user_id, n, concurrent=True):
     # Check if user_id has rated items in that dataset
-    user_id_valid = user_id if query.user_rating_exists(user_id, dataset) else None
+    rated = authentication.get_rated_items()
+    user_id_valid = user_id if rated.count(dataset) > 0 else None
 
     # First row
     add_row_header(f"Popular {dataset}")
@@ -157,46 +281,60 @@ def add_recommendations(dataset, user_id, n):
     else:
         make_row_placeholder(n, third_row)
 
-    def hydrate():
-        # First row content
-        df = query.popularity(n, dataset, exclude_rated_by=user_id_valid)
+    def load_popular():
+        return query.popularity(n, dataset, rated=rated)
+
+    def render_popular(df):
         make_row(df, n, first_row)
 
-        # Second row content
+    def load_similar():
         if user_id_valid is not None:
-            # Iteratate over items until a valid recommendation is found
-            df = []
-            attempt = 0
-            while len(df) == 0 and attempt < 5:
-                ref_item = query.get_random_high_rated(user_id_valid, dataset=dataset)
-                title = format_title(ref_item.title)
-                add_row_header(header.format(title=title), second_row_header)
-                df = query.item_based(ref_item.item_id, n, dataset, exclude_rated_by=user_id_valid)
-                attempt += 1
+            ref_items = query.get_high_rated(user_id_valid, dataset, 5)
         else:
-            # Randomly select reference item from popular items above
-            ref_item = df.sample(1).iloc[0]
-            title = format_title(ref_item.title)
-            add_row_header(header.format(title=title), second_row_header)
-            df = query.item_based(ref_item.item_id, n, dataset)
+            # Randomly select reference items from the popular items of the first row
+            df = query.popularity(n, dataset, rated=rated)
+            ref_items = df.sample(min(5, len(df)))
+
+        # Use the first reference item that has recommendations
+        recommendations = query.item_based_batch(
+            ref_items.item_id.to_list(), n, dataset, rated=rated
+        )
+        ref_item = ref_items.iloc[0]
+        for _, candidate in ref_items.iterrows():
+            if candidate.item_id in recommendations:
+                ref_item = candidate
+                break
+        return ref_item, recommendations.get(ref_item.item_id, ref_items.iloc[:0])
+
+    def render_similar(result):
+        ref_item, df = result
+        title = format_title(ref_item.title)
+        add_row_header(header.format(title=title), second_row_header)
         make_row(df, n, second_row)
 
-        # Third row content
+    def load_personal():
+        return query.user_based(user_id_valid, n, dataset, rated=rated)
+
+    def render_personal(df):
+        if len(df) > 0:
+            make_row(df, n, third_row)
+        else:
+            third_row.info(
+                "**All caught up!**"
+                "   \nStart rating more items to get more recommendations"
+                "   \nRecommendations are updated every 24 hours"
+            )
+
+    def hydrate():
+        tasks = [(load_popular, render_popular), (load_similar, render_similar)]
         if user_id_valid is not None:
-            df = query.user_based(user_id_valid, n, dataset)
-            if len(df) > 0:
-                make_row(df, n, third_row)
-            else:
-                third_row.info(
-                    "**All caught up!**"
-                    "   \nStart rating more items to get more recommendations"
-                    "   \nRecommendations are updated every 24 hours"
-                )
+            tasks.append((load_personal, render_personal))
+        hydrate_rows(tasks, concurrent)
 
     return hydrate
 
 
-def add_mixed_recommendations(n):
+def add_mixed_recommendations(n, concurrent=True):
     n_half = n // 2
     n = 2 * n_half  # Make sure n is even
 
@@ -208,46 +346,37 @@ def add_mixed_recommendations(n):
     </h2>"""
     )
 
-    html_element = """<div class="rec_element">
-        <img src="{img_src}" alt="" class="rec_image">
-        <div class="rec_text">
-            <p></p>
-            <p>{title}</p>
-            <p>{secondary}</p>
-        </div>
-    </div><br>"""
+    # One slot per half, each filled with a single row payload
+    books_column, _, mangas_column = st.columns([n_half, 0.5, n_half])
+    book_slot, manga_slot = books_column.empty(), mangas_column.empty()
+    make_row_placeholder(n_half, book_slot)
+    make_row_placeholder(n_half, manga_slot)
 
-    col_width = [1] * n_half + [0.5] + [1] * n_half
-    rec_row = st.empty()
-    make_row_placeholder(col_width, rec_row, skip=n_half)
+    def render(slot):
+        def render_half(df):
+            slot.html(row_html(rec_elements(df, link=False), n_half))
 
-    def hydrate():
-        df_books = query.popularity(n_half, "books")
-        df_mangas = query.popularity(n_half, "mangas")
-        rows = list(df_books.iterrows()) + [(None, None)] + list(df_mangas.iterrows())
+        return render_half
 
-        columns = rec_row.columns(col_width)
-        for col, (_, row) in zip(columns, rows):
-            if row is None:
-                continue
-            with col:
-                st.markdown(
-                    html_element.format(
-                        item_id=row["item_id"],
-                        title=row["title"],
-                        secondary=row.iloc[2],
-                        img_src=row["image"],
-                    ),
-                    unsafe_allow_html=True,
-                )
+    def hydrate():
+        tasks = [
+            (lambda: query.popularity(n_half, "books"), render(book_slot)),
+            (lambda: query.popularity(n_half, "mangas"), render(manga_slot)),
+        ]
+        hydrate_rows(tasks, concurrent)
 
     return hydrate
 
 
-def filter_builder(filter_options, display_names=None):
+def filter_builder(filter_options, display_names=None, dataset=None):
     """
     Adds filter options for the user to query the database
 
+    The filters are normalized, so that equivalent inputs lead to the
+    same search and share cached results. The rating filter is turned
+    into a filter of the item_ids rated by the user, so that the search
+    only reads the catalog.
+
     Parameters
     ----------
     filter_options : dict
@@ -259,16 +388,15 @@ def filter_builder(filter_options, display_names=None):
         List of display names for the columns in the filter. Defaults to
         the table column names
 
+    dataset : {"books", "mangas"}, optional
+        Dataset of the items, required for the rating filter
+
     Returns
     -------
-    where_query : str
-        Partial SQL query to filter the database (WHERE clause)
-
-    query_params : dict
-        Mapping of query parameters to pass to the SQL query
+    filters : list of tuple
+        Filters to pass to query.get_filtered
     """
-    clauses = []
-    query_params = {}
+    filters = []
     if display_names is None:
         display_names = list(filter_options.keys())
     with st.container(border=True):
@@ -279,9 +407,10 @@ def filter_builder(filter_options, display_names=None):
             if isinstance(filter_type, str) and filter_type == "text":
                 # Text search
                 user_text_input = st.text_input(f"Search {disp_name}", key=f"{column}_text_input")
+                # The search ignores the case, so does the cache key
+                user_text_input = " ".join(user_text_input.split()).lower()
                 if user_text_input:
-                    query_params[column] = f"%{user_text_input}%"
-                    clauses.append(column + f" ILIKE %({column})s")
+                    filters.append(("text", column, user_text_input))
             elif isinstance(filter_type, str) and filter_type == "rating":
                 # Rating slider
                 col1, col2 = st.columns(2, gap="large", vertical_alignment="center")
@@ -298,15 +427,15 @@ def filter_builder(filter_options, display_names=None):
                     value=True,
                     key=f"{column}_bool_checkbox",
                 )
-                query_params[f"{column}_min"] = int(user_num_input[0])
-                query_params[f"{column}_max"] = int(user_num_input[1])
+                low, high = int(user_num_input[0]), int(user_num_input[1])
+                rated = authentication.get_rated_items()
                 if user_bool_input:
-                    clauses.append(
-                        "(" + column + f" BETWEEN %({column}_min)s AND %({column}_max)s"
-                        " OR " + column + " IS NULL)"
-                    )
+                    # Leave out the items rated outside of the range
+                    excluded = rated.between(dataset, low, high, invert=True)
+                    if excluded:
+                        filters.append(("not_in", "item_id", excluded))
                 else:
-                    clauses.append(column + f" BETWEEN %({column}_min)s AND %({column}_max)s")
+                    filters.append(("in", "item_id", rated.between(dataset, low, high)))
             elif (
                 isinstance(filter_type, (tuple, list))
                 and all(isinstance(i, (int, float)) for i in filter_type)
@@ -335,12 +464,13 @@ def filter_builder(filter_options, display_names=None):
                     key=f"{column}_num_slider",
                 )
                 if is_int:
-                    query_params[f"{column}_min"] = int(user_num_input[0])
-                    query_params[f"{column}_max"] = int(user_num_input[1])
+                    filters.append(
+                        ("between", column, int(user_num_input[0]), int(user_num_input[1]))
+                    )
                 else:
-                    query_params[f"{column}_min"] = float(user_num_input[0])
-                    query_params[f"{column}_max"] = float(user_num_input[1])
-                clauses.append(column + f" BETWEEN %({column}_min)s AND %({column}_max)s")
+                    filters.append(
+                        ("between", column, float(user_num_input[0]), float(user_num_input[1]))
+                    )
             else:
                 # Categorical values
                 filter_type = list(map(str, filter_type))
@@ -351,17 +481,13 @@ def filter_builder(filter_options, display_names=None):
                     placeholder="Choose to filter",
                     key=f"{column}_cat_multiselect",
                 )
-                for i, cat in enumerate(user_cat_input):
-                    query_params[f"{column}_{i}"] = f"%{cat}%"
-                    clauses.append(column + f" ILIKE %({column}_{i})s")
+                for cat in sorted(user_cat_input):
+                    filters.append(("contains", column, cat))
 
-    where_query = " AND ".join(clauses)
-    if where_query:
-        where_query = "WHERE " + where_query
-    return where_query, query_params
+    return filters
 
 
-def update_rating(dataset, user_id, item_id, rating_before, key):
+def update_rating(dataset, user_id, item_id, key):
     """
     Update the user rating in the database
 
@@ -376,68 +502,146 @@ def update_rating(dataset, user_id, item_id, rating_before, key):
     item_id : int
         Item ID to update the rating for
 
-    rating_before : int
-        Previous rating before the update
-
     key : str
         Session state key for the rating
     """
     rating = st.session_state.get(key, pd.NA)
     if not pd.isna(rating):
-        rating += 1
-        if rating != rating_before:
-            query.update_rating(dataset, user_id, item_id, rating)
-            st.toast("Rating updated", icon="⭐")
+        save_rating(dataset, user_id, item_id, rating + 1)
 
 
-def add_explorer(dataset, user_id, n, filter_options, display_names=None):
+def update_grid_rating(dataset, user_id, item_ids, key):
     """
-    Add the explorer for the database
+    Update the user rating clicked in the explorer grid
 
     Parameters
     ----------
     dataset : {"books", "mangas"}
-        Database to explore
+        Database to update the rating in
 
     user_id : int
-        User ID to get the ratings for
+        User ID to update the rating for
 
-    n : int
-        Maximum number of items to display
+    item_ids : list
+        Item IDs in the order of the grid
 
-    filter_options : dict
-        Mapping of column names to select for filtering and their filter
+    key : str
+        Session state key of the grid
+    """
+    value = st.session_state.get(key)
+    if value is None:
+        return
+    save_rating(dataset, user_id, item_ids[value["index"]], int(value["rating"]))
 
-    display_names : list, optional
-        List of display names for the columns in the filter. Defaults
-        to the column names
+
+def save_rating(dataset, user_id, item_id, rating):
     """
-    st.markdown(
-        f"Have a look through our {dataset[:-1]} database and use filters "
-        "to find what you are looking for!"
+    Save a changed rating, showing it in the session before the write
+
+    The rated items of the session are updated first, so that the rerun
+    shows the new rating without reloading it. The update is undone if
+    the write fails.
+    """
+    rated = authentication.get_rated_items()
+    rating_before = rated.rating(dataset, item_id)
+    if rating == rating_before:
+        return
+
+    rated.set_rating(dataset, item_id, rating)
+    try:
+        query.update_rating(dataset, user_id, item_id, rating)
+    except SQLAlchemyError:
+        if rating_before is None:
+            rated.remove(dataset, item_id)
+        else:
+            rated.set_rating(dataset, item_id, rating_before)
+        st.toast("Rating could not be saved", icon="⚠️")
+        return
+    st.toast("Rating updated", icon="⭐")
+
+
+def explorer_html(df, dataset, ratings=True):
+    """
+    Build the HTML of the explorer grid of all items at once
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Items with their details, and their ratings in the column rating
+        if the user is logged in
+
+    dataset : {"books", "mangas"}
+        Dataset of the items
+
+    ratings : bool, optional
+        Whether to add stars to rate the items. Default is True
+
+    Returns
+    -------
+    html : str
+        HTML of the grid
+    """
+    title = _escape(df["title"].str.replace(tv_keywords, "", regex=True))
+    categories = _escape(df.iloc[:, 3])
+    if dataset == "mangas":
+        categories = (
+            "<div class='explorer_genres'><span>"
+            + categories.str.replace("|", "</span><span>", regex=False)
+            + "</span></div>"
+        )
+    details = (
+        '<div class="explorer_details"><div class="explorer_text"><b>'
+        + title
+        + '</b><br /><span class="secondary">'
+        + _escape(df.iloc[:, 2])
+        + '</span><br /><span class="secondary">'
+        + categories
+        + '</span><div class="explorer_details_screen"></div></div>'
     )
+    if ratings:
+        # Stars of each rating from 0 (not rated) to 5
+        stars = [
+            "".join(
+                f'<span data-star="{star}"{" class=active" if star <= rating else ""}>★</span>'
+                for star in range(1, 6)
+            )
+            for rating in range(6)
+        ]
+        rating = df["rating"].fillna(0).astype(int) if "rating" in df.columns else 0
+        index = pd.Series(range(len(df)), index=df.index).astype(str)
+        details += (
+            '<div class="explorer_stars" data-index="'
+            + index
+            + '">'
+            + pd.Series(rating, index=df.index).map(dict(enumerate(stars)))
+            + "</div>"
+        )
+    else:
+        details += '<div class="explorer_login">★ Log in to rate</div>'
+    items = '<div class="explorer_item">' + rec_elements(df) + details + "</div></div>"
+    return '<div class="explorer_grid">' + "".join(items) + "</div>"
 
-    # Filter the database
-    where_query, query_params = filter_builder(filter_options, display_names)
-    df = query.get_filtered(dataset, n, user_id, where_query, query_params)
 
+def add_explorer_columns(df, dataset, user_id):
+    """
+    Add the items of the explorer with one Streamlit element per detail
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Items to display, with the ratings of the user
+
+    dataset : {"books", "mangas"}
+        Database of the items
+
+    user_id : int
+        User ID to rate the items for
+    """
     # Fill the ratings
     for _, row in df.iterrows():
         if not pd.isna(row.get("rating", pd.NA)):
             key = f"rate_{row['item_id']}"
-            st.session_state[key] = row["rating"] - 1
-
-    # Check for empty results
-    st.html("<br>")
-    if len(df) <= 0:
-        st.html(
-            """
-        <div class="explorer_info">
-            <div>No items found with the given filters.</div>
-        </div>
-        """
-        )
-        return
+            st.session_state[key] = int(row["rating"]) - 1
 
     # HTML elements for the items
     if "author" in df.columns:
@@ -494,12 +698,127 @@ def add_explorer(dataset, user_id, n, filter_options, display_names=None):
                 "stars",
                 key=key,
                 on_change=update_rating,
-                args=(dataset, user_id, row["item_id"], row.get("rating", pd.NA), key),
+                args=(dataset, user_id, row["item_id"], key),
                 disabled=user_id is None,
             )
         else:
             col2.markdown(":material/star: Log in to rate")
 
+
+@st.fragment
+def explorer_results(df, dataset, user_id, grid=True):
+    """
+    Add the items of the explorer with their ratings
+
+    Rating an item only reruns this fragment with the same items, so
+    that neither the filters nor the query run again.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Items to display
+
+    dataset : {"books", "mangas"}
+        Database of the items
+
+    user_id : int
+        User ID to rate the items for
+
+    grid : bool, optional
+        Whether to render all items as one grid, see add_explorer.
+        Default is True
+    """
+    # The ratings of the session include the ones changed since the query
+    if user_id is not None:
+        rated = authentication.get_rated_items()
+        df = df.assign(rating=rated.get_ratings(dataset, df["item_id"]))
+
+    if grid:
+        html = explorer_html(df, dataset, ratings=user_id is not None)
+        if user_id is None:
+            st.html(html)
+        else:
+            # Ratings of all items arrive through one component and one callback
+            key = f"explorer_grid_{dataset}"
+            item_ids = df["item_id"].to_list()
+            with open("style/style.css") as f:
+                css = f.read()
+            _explorer_grid(
+                html=html,
+                css=css,
+                key=key,
+                default=None,
+                on_change=functools.partial(update_grid_rating, dataset, user_id, item_ids, key),
+            )
+    else:
+        add_explorer_columns(df, dataset, user_id)
+
+
+def _searched_columns(filter_options):
+    """Columns of the text and the categorical filters of filter_builder"""
+    columns = []
+    for column, filter_type in filter_options.items():
+        if isinstance(filter_type, str):
+            if filter_type == "text":
+                columns.append(column)
+        elif not all(isinstance(i, (int, float)) for i in filter_type):
+            columns.append(column)
+    return columns
+
+
+def add_explorer(dataset, user_id, n, filter_options, display_names=None, grid=True):
+    """
+    Add the explorer for the database
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Database to explore
+
+    user_id : int
+        User ID to get the ratings for
+
+    n : int
+        Maximum number of items to display
+
+    filter_options : dict
+        Mapping of column names to select for filtering and their filter
+
+    display_names : list, optional
+        List of display names for the columns in the filter. Defaults
+        to the column names
+
+    grid : bool, optional
+        Whether to render all items as one grid with one rating
+        callback. Otherwise each item is rendered with its own
+        Streamlit elements. Default is True
+    """
+    st.markdown(
+        f"Have a look through our {dataset[:-1]} database and use filters "
+        "to find what you are looking for!"
+    )
+
+    # Index the searched columns while the user enters the filters
+    search.warm_up(dataset, _searched_columns(filter_options))
+
+    # Filter the database
+    filters = filter_builder(filter_options, display_names, dataset)
+    df = query.get_filtered(dataset, n, filters)
+
+    # Check for empty results
+    st.html("<br>")
+    if len(df) <= 0:
+        st.html(
+            """
+        <div class="explorer_info">
+            <div>No items found with the given filters.</div>
+        </div>
+        """
+        )
+        return
+
+    explorer_results(df, dataset, user_id, grid)
+
     # Add note about limited results
     if len(df) >= n:
         st.html(
@@ -0,0 +1,492 @@
+"""
+Vectorized k-nearest neighbor kernels for collaborative filtering
+
+The functions reproduce the baseline estimates and the pearson_baseline
+similarity of the surprise KNNBaseline model on sparse matrices with
+NumPy and SciPy. They avoid the dense similarity matrix and the
+per-item Python loops, so their cost grows with the number of ratings
+rather than with the square of the number of items.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def rating_matrix(user_index, item_index, ratings, n_users, n_items):
+    """
+    Build the sparse user x item rating matrix
+
+    Parameters
+    ----------
+    user_index : np.ndarray
+        Inner user index of each rating
+
+    item_index : np.ndarray
+        Inner item index of each rating
+
+    ratings : np.ndarray
+        Rating values
+
+    n_users : int
+        Number of users
+
+    n_items : int
+        Number of items
+
+    Returns
+    -------
+    matrix : sp.csr_matrix
+        Ratings with users as rows and items as columns
+    """
+    matrix = sp.csr_matrix(
+        (np.asarray(ratings, dtype=np.float64), (user_index, item_index)),
+        shape=(n_users, n_items),
+    )
+    matrix.sort_indices()
+    return matrix
+
+
+def baselines(matrix, n_epochs=10, reg_u=15, reg_i=10):
+    """
+    Estimate user and item baselines with alternating least squares
+
+    Same procedure and defaults as the "als" baseline of surprise.
+
+    Parameters
+    ----------
+    matrix : sp.csr_matrix
+        Ratings with users as rows and items as columns
+
+    n_epochs : int, optional
+        Number of ALS iterations. Default is 10
+
+    reg_u : float, optional
+        Regularization of the user baselines. Default is 15
+
+    reg_i : float, optional
+        Regularization of the item baselines. Default is 10
+
+    Returns
+    -------
+    global_mean : float
+        Mean of all ratings
+
+    bu : np.ndarray
+        User baselines
+
+    bi : np.ndarray
+        Item baselines
+    """
+    n_users, n_items = matrix.shape
+    users = np.repeat(np.arange(n_users), np.diff(matrix.indptr))
+    items = matrix.indices
+    r = matrix.data
+
+    global_mean = r.mean()
+    user_count = np.bincount(users, minlength=n_users)
+    item_count = np.bincount(items, minlength=n_items)
+
+    bu = np.zeros(n_users)
+    bi = np.zeros(n_items)
+    for _ in range(n_epochs):
+        dev_i = np.bincount(items, weights=r - global_mean - bu[users], minlength=n_items)
+        bi = dev_i / (reg_i + item_count)
+        dev_u = np.bincount(users, weights=r - global_mean - bi[items], minlength=n_users)
+        bu = dev_u / (reg_u + user_count)
+
+    return global_mean, bu, bi
+
+
+def residuals(matrix, global_mean, bu, bi):
+    """
+    Subtract the baseline estimate from every rating
+
+    Parameters
+    ----------
+    matrix : sp.csr_matrix
+        Ratings with users as rows and items as columns
+
+    global_mean : float
+        Mean of all ratings
+
+    bu : np.ndarray
+        User baselines
+
+    bi : np.ndarray
+        Item baselines
+
+    Returns
+    -------
+    residuals : sp.csr_matrix
+        Deviation of the ratings from the baseline, same sparsity
+        structure as the rating matrix
+    """
+    users = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    data = matrix.data - (global_mean + bu[users] + bi[matrix.indices])
+    return sp.csr_matrix((data, matrix.indices.copy(), matrix.indptr.copy()), shape=matrix.shape)
+
+
+def _values_at(matrix, keys, n_cols):
+    """Look up the values of a canonical CSR matrix at flat row * n_cols + col keys"""
+    matrix = matrix.tocoo()
+    matrix_keys = matrix.row.astype(np.int64) * n_cols + matrix.col
+    order = np.argsort(matrix_keys)
+    matrix_keys = matrix_keys[order]
+    pos = np.searchsorted(matrix_keys, keys)
+    pos_clipped = np.minimum(pos, len(matrix_keys) - 1)
+    found = (pos < len(matrix_keys)) & (matrix_keys[pos_clipped] == keys)
+    values = np.zeros(len(keys))
+    values[found] = matrix.data[order][pos_clipped[found]]
+    return values
+
+
+def pearson_baseline(residuals, rows=None, shrinkage=100, min_support=1, dtype=np.float64):
+    """
+    Shrunk pearson_baseline similarity between the rows of a matrix
+
+    Pairs of rows are compared over their common columns only, exactly
+    like surprise. Self-similarities are not included in the result.
+
+    Parameters
+    ----------
+    residuals : sp.csr_matrix
+        Baseline residuals, one row per entity to compare (e.g. items
+        as rows and users as columns for item-item similarity)
+
+    rows : np.ndarray, optional
+        Indices of the rows to compute the similarities for. Default is
+        all rows
+
+    shrinkage : int, optional
+        Shrinkage parameter. Default is 100
+
+    min_support : int, optional
+        Minimum number of common columns for a non-zero similarity.
+        Default is 1
+
+    dtype : np.dtype, optional
+        Floating point type of the computation. Default is np.float64
+
+    Returns
+    -------
+    similarity : sp.csr_matrix
+        Similarity of the selected rows (as rows) to all rows (as
+        columns) for the pairs that share at least one column
+    """
+    if rows is None:
+        rows = np.arange(residuals.shape[0])
+    operands = _similarity_operands(residuals, dtype)
+    return _pearson_block(operands, np.asarray(rows), shrinkage, min_support)
+
+
+def _similarity_operands(residuals, dtype):
+    """Residuals, indicator and squared residuals, row-wise and transposed"""
+    residuals = residuals.astype(dtype)
+    indicator = residuals.copy()
+    indicator.data = np.ones_like(indicator.data)
+    squared = residuals.multiply(residuals).tocsr()
+    return dict(
+        residuals=residuals,
+        indicator=indicator,
+        squared=squared,
+        residuals_t=residuals.T.tocsr(),
+        indicator_t=indicator.T.tocsr(),
+        squared_t=squared.T.tocsr(),
+    )
+
+
+def _pearson_block(operands, rows, shrinkage, min_support):
+    """Similarity of the given rows to all rows, see pearson_baseline"""
+    n = operands["residuals"].shape[0]
+    dtype = operands["residuals"].dtype
+    block = operands["residuals"][rows]
+    block_indicator = operands["indicator"][rows]
+    block_squared = operands["squared"][rows]
+
+    # The support pattern defines which pairs are compared. Products
+    # that sum to exactly zero are dropped by SciPy, so the other
+    # statistics are looked up on this pattern
+    freq = (block_indicator @ operands["indicator_t"]).tocoo()
+    keep = (freq.col != rows[freq.row]) & (freq.data >= min_support)
+    block_rows, cols, freq = freq.row[keep], freq.col[keep], freq.data[keep]
+    keys = block_rows.astype(np.int64) * n + cols
+
+    prods = _values_at(block @ operands["residuals_t"], keys, n).astype(dtype)
+    sq_i = _values_at(block_squared @ operands["indicator_t"], keys, n).astype(dtype)
+    sq_j = _values_at(block_indicator @ operands["squared_t"], keys, n).astype(dtype)
+
+    denominator = np.sqrt(sq_i * sq_j)
+    sim = np.divide(prods, denominator, out=np.zeros_like(prods), where=denominator > 0)
+    sim *= (freq - 1) / (freq - 1 + shrinkage)
+
+    similarity = sp.csr_matrix((sim, (block_rows, cols)), shape=(len(rows), n), dtype=dtype)
+    similarity.sort_indices()
+    return similarity
+
+
+def neighbors(residuals, k, rows=None, shrinkage=100, min_support=1, block_size=1024):
+    """
+    Nearest neighbors by pearson_baseline similarity, block by block
+
+    The similarities are computed for one block of rows at a time in
+    single precision, and only the k nearest neighbors of each row are
+    retained. The full similarity matrix never exists at once, so the
+    peak memory is set by the block size instead of the squared number
+    of rows.
+
+    Parameters
+    ----------
+    residuals : sp.csr_matrix
+        Baseline residuals, one row per entity to compare
+
+    k : int
+        Number of neighbors to keep per row
+
+    rows : np.ndarray, optional
+        Indices of the rows to find the neighbors for. Default is all
+        rows
+
+    shrinkage : int, optional
+        Shrinkage parameter. Default is 100
+
+    min_support : int, optional
+        Minimum number of common columns for a non-zero similarity.
+        Default is 1
+
+    block_size : int, optional
+        Number of rows to compute the similarities for at once. Default
+        is 1024
+
+    Returns
+    -------
+    indices : np.ndarray
+        Array of shape (len(rows), k) with the indices of the neighbors
+        in descending order of similarity, padded with -1
+
+    values : np.ndarray
+        Array of shape (len(rows), k) with the similarities as float32,
+        padded with NaN
+    """
+    if rows is None:
+        rows = np.arange(residuals.shape[0])
+    rows = np.asarray(rows)
+
+    operands = _similarity_operands(residuals, np.float32)
+    indices = np.full((len(rows), k), -1, dtype=np.int32)
+    values = np.full((len(rows), k), np.nan, dtype=np.float32)
+    for start in range(0, len(rows), block_size):
+        block = rows[start : start + block_size]
+        similarity = _pearson_block(operands, block, shrinkage, min_support)
+        block_indices, block_values = top_k(similarity, k, block_size)
+        indices[start : start + len(block)] = block_indices
+        values[start : start + len(block)] = block_values
+
+    return indices, values
+
+
+def _top_dense(values, k):
+    """Column positions and values of the k largest entries per row, in descending order"""
+    width = values.shape[1]
+    kk = min(k, width)
+    if kk < width:
+        selected = np.argpartition(-values, kk - 1, axis=1)[:, :kk]
+    else:
+        selected = np.broadcast_to(np.arange(width), values.shape)
+    selected_values = np.take_along_axis(values, selected, axis=1)
+    order = np.argsort(-selected_values, axis=1, kind="stable")
+    selected = np.take_along_axis(selected, order, axis=1)
+    selected_values = np.take_along_axis(selected_values, order, axis=1)
+    return selected, selected_values
+
+
+def top_k(similarity, k, block_size=1024):
+    """
+    Select the k most similar columns of every row
+
+    The rows are processed in blocks. Each block is padded into a dense
+    array that holds only the stored entries and partially sorted at
+    once.
+
+    Parameters
+    ----------
+    similarity : sp.csr_matrix
+        Sparse similarity matrix
+
+    k : int
+        Number of neighbors to keep per row
+
+    block_size : int, optional
+        Number of rows to sort at once. Default is 1024
+
+    Returns
+    -------
+    indices : np.ndarray
+        Array of shape (n_rows, k) with the column indices of the
+        neighbors in descending order of similarity, padded with -1
+
+    values : np.ndarray
+        Array of shape (n_rows, k) with the similarities, padded with
+        NaN
+    """
+    n_rows = similarity.shape[0]
+    indptr = similarity.indptr
+    lengths = np.diff(indptr)
+    indices = np.full((n_rows, k), -1, dtype=np.int32)
+    values = np.full((n_rows, k), np.nan, dtype=np.float32)
+
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        counts = lengths[start:stop]
+        width = counts.max(initial=0)
+        if width == 0:
+            continue
+
+        # Scatter the stored entries of the block into a padded array
+        lo, hi = indptr[start], indptr[stop]
+        rows = np.repeat(np.arange(stop - start), counts)
+        cols = np.arange(hi - lo) - np.repeat(indptr[start:stop] - lo, counts)
+        block_values = np.full((stop - start, width), -np.inf)
+        block_values[rows, cols] = similarity.data[lo:hi]
+        block_indices = np.full((stop - start, width), -1, dtype=np.int32)
+        block_indices[rows, cols] = similarity.indices[lo:hi]
+
+        selected, selected_values = _top_dense(block_values, k)
+        kk = selected.shape[1]
+        selected_indices = np.take_along_axis(block_indices, selected, axis=1)
+
+        valid = np.isfinite(selected_values)
+        indices[start:stop, :kk] = np.where(valid, selected_indices, -1)
+        values[start:stop, :kk] = np.where(valid, selected_values, np.nan)
+
+    return indices, values
+
+
+def predict_top_n(
+    matrix,
+    global_mean,
+    bu,
+    bi,
+    neighbors,
+    similarities,
+    users,
+    n,
+    min_k=1,
+    rating_scale=(1, 5),
+    block_size=1024,
+):
+    """
+    Predict the n best unrated items for each user
+
+    The prediction is the KNNBaseline estimate: the baseline of the
+    user and item plus the similarity-weighted baseline residuals of the
+    neighbors that rated the item. Only neighbors with a positive
+    similarity contribute. The neighbors of a user are the users given
+    in `neighbors`, i.e. the user's k most similar users overall.
+
+    All unrated items of a block of users are scored at once, so the
+    unrated (user, item) pairs are never materialized as a list. The
+    items are scored in tiles of block_size columns in single precision,
+    so the dense arrays of a block hold block_size by block_size values
+    regardless of the number of items.
+
+    Parameters
+    ----------
+    matrix : sp.csr_matrix
+        Ratings with users as rows and items as columns
+
+    global_mean : float
+        Mean of all ratings
+
+    bu : np.ndarray
+        User baselines
+
+    bi : np.ndarray
+        Item baselines
+
+    neighbors : np.ndarray
+        Array of shape (n_users, k) with the inner indices of the
+        neighbors of each user, padded with -1
+
+    similarities : np.ndarray
+        Array of shape (n_users, k) with the neighbor similarities
+
+    users : np.ndarray
+        Inner indices of the users to predict for
+
+    n : int
+        Number of items to recommend per user
+
+    min_k : int, optional
+        Minimum number of neighbors that rated an item to deviate from
+        the baseline. Default is 1
+
+    rating_scale : tuple, optional
+        Range to clip the predictions to. Default is (1, 5)
+
+    block_size : int, optional
+        Number of users and of items to score at once. Default is 1024
+
+    Returns
+    -------
+    items : np.ndarray
+        Array of shape (len(users), n) with the inner indices of the
+        recommended items in descending order of prediction, padded
+        with -1
+    """
+    users = np.asarray(users, dtype=np.int64)
+    n_users, n_items = matrix.shape
+    res = residuals(matrix, global_mean, bu, bi).astype(np.float32)
+    indicator = matrix.astype(np.float32)
+    indicator.data = np.ones_like(indicator.data)
+
+    # Columns of the items by tile, so that a block never exceeds
+    # block_size users by block_size items
+    res, indicator = res.tocsc(), indicator.tocsc()
+    tiles = [(first, min(first + block_size, n_items)) for first in range(0, n_items, block_size)]
+    bi = np.asarray(bi, dtype=np.float32)
+    items = np.full((len(users), n), -1, dtype=np.int32)
+
+    for start in range(0, len(users), block_size):
+        block = users[start : start + block_size]
+
+        # Sparse weights of the positive neighbors of the block
+        nb = neighbors[block]
+        sims = similarities[block]
+        valid = (nb >= 0) & (sims > 0)
+        rows = np.repeat(np.arange(len(block)), valid.sum(axis=1))
+        weights = sp.csr_matrix(
+            (sims[valid].astype(np.float32), (rows, nb[valid])), shape=(len(block), n_users)
+        )
+        support = weights.copy()
+        support.data = np.ones_like(support.data)
+        baseline = np.float32(global_mean) + bu[block, None].astype(np.float32)
+        rated = matrix[block].tocsc()
+
+        # Best items so far, merged with the best items of each tile
+        best = np.zeros((len(block), 0), dtype=np.int64)
+        best_values = np.zeros((len(block), 0), dtype=np.float32)
+        for first, last in tiles:
+            numerator = (weights @ res[:, first:last]).toarray()
+            denominator = (weights @ indicator[:, first:last]).toarray()
+            count = (support @ indicator[:, first:last]).toarray().astype(np.int32)
+
+            # Baseline plus the weighted neighbor deviation
+            estimate = baseline + bi[None, first:last]
+            deviate = (count >= min_k) & (denominator > 0)
+            estimate[deviate] += numerator[deviate] / denominator[deviate]
+            np.clip(estimate, *rating_scale, out=estimate)
+
+            # Exclude the items the users have rated already
+            rated_rows, rated_cols = rated[:, first:last].nonzero()
+            estimate[rated_rows, rated_cols] = -np.inf
+
+            selected, selected_values = _top_dense(estimate, n)
+            candidates = np.concatenate([best, selected + first], axis=1)
+            candidate_values = np.concatenate([best_values, selected_values], axis=1)
+            order, best_values = _top_dense(candidate_values, n)
+            best = np.take_along_axis(candidates, order, axis=1)
+
+        kk = best.shape[1]
+        items[start : start + len(block), :kk] = np.where(np.isfinite(best_values), best, -1)
+
+    return items
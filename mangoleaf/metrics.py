@@ -0,0 +1,243 @@
+"""
+Measure the latency of the queries and the load of the connection pools
+
+The query functions record their latency and the number of rows they
+return. SQLAlchemy event hooks on each engine record the latency of the
+statements, the wait for a pooled connection, the pool saturation and
+connection errors. Statements slower than SLOW_QUERY_SECONDS are
+printed. The metrics of the process can be exported as text in the
+Prometheus exposition format.
+"""
+
+import functools
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds of the latency buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, np.inf)
+
+# Statements that take longer are printed with their duration
+SLOW_QUERY_SECONDS = float(os.environ.get("MANGOLEAF_SLOW_QUERY_SECONDS", "") or 0.5)
+
+_histograms = dict()
+_counters = dict()
+_gauges = dict()
+_lock = threading.Lock()
+
+
+class Histogram:
+    """
+    Counts of observations in cumulative buckets
+
+    Parameters
+    ----------
+    buckets : tuple of float, optional
+        Upper bounds of the buckets in ascending order, the last one
+        being infinity. Default is BUCKETS
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = np.asarray(buckets, dtype=float)
+        self.counts = np.zeros(len(buckets), dtype=np.int64)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[np.searchsorted(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    """Record an observation in a histogram"""
+    with _lock:
+        histogram = _histograms.setdefault(_key(name, labels), Histogram())
+        histogram.observe(value)
+
+
+def increment(name, value=1, **labels):
+    """Increase a counter"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge to its current value"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def reset():
+    """Remove all recorded metrics"""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+def _rows(result):
+    """Number of rows in a query result"""
+    if result is None:
+        return 0
+    if isinstance(result, (str, bytes)) or not hasattr(result, "__len__"):
+        return 1
+    return len(result)
+
+
+def timed(function):
+    """
+    Decorate a query function to record its latency and its rows
+
+    Records the histogram mangoleaf_query_seconds and the counters
+    mangoleaf_query_rows_total and mangoleaf_query_errors_total, labeled
+    by the name of the function.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            increment("mangoleaf_query_errors_total", function=function.__name__)
+            raise
+        finally:
+            observe(
+                "mangoleaf_query_seconds", time.perf_counter() - start, function=function.__name__
+            )
+        increment("mangoleaf_query_rows_total", _rows(result), function=function.__name__)
+        return result
+
+    return wrapper
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records the wait for a connection and timeouts"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        engine = self.logging_name or "default"
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            increment("mangoleaf_pool_timeouts_total", engine=engine)
+            raise
+        finally:
+            observe("mangoleaf_pool_wait_seconds", time.perf_counter() - start, engine=engine)
+
+
+def instrument_engine(engine, name):
+    """
+    Record the statements, the pool usage and the errors of an engine
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        Engine to instrument
+
+    name : str
+        Name of the engine to label the metrics with
+    """
+
+    def update_pool(returned=0):
+        pool = engine.pool
+        capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0)
+        # The returned connection is only counted as checked in after the event
+        checked_out = pool.checkedout() - returned
+        set_gauge("mangoleaf_pool_checked_out", checked_out, engine=name)
+        set_gauge("mangoleaf_pool_saturation", checked_out / max(capacity, 1), engine=name)
+
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        update_pool()
+
+    def checkin(dbapi_connection, connection_record):
+        update_pool(returned=1)
+
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("statement_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - connection.info["statement_start"].pop()
+        observe("mangoleaf_statement_seconds", duration, engine=name)
+        if duration > SLOW_QUERY_SECONDS:
+            statement = " ".join(statement.split())[:200]
+            print(f"Slow query on {name} ({duration:.3f} s): {statement}", file=sys.stderr)
+
+    def handle_error(context):
+        if context.connection is not None:
+            context.connection.info.pop("statement_start", None)
+        kind = "disconnect" if context.is_disconnect else "statement"
+        increment("mangoleaf_connection_errors_total", engine=name, kind=kind)
+
+    def invalidate(dbapi_connection, connection_record, exception):
+        increment("mangoleaf_pool_invalidations_total", engine=name)
+
+    event.listen(engine, "checkout", checkout)
+    event.listen(engine, "checkin", checkin)
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine, "handle_error", handle_error)
+    event.listen(engine, "invalidate", invalidate)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def _number(value):
+    """Format a value without losing digits, as Prometheus parses it"""
+    if value == np.inf:
+        return "+Inf"
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    return repr(float(value))
+
+
+def prometheus_text():
+    """
+    Export the metrics in the Prometheus text exposition format
+
+    Returns
+    -------
+    text : str
+        Current value of all metrics of the process
+    """
+    with _lock:
+        histograms = {
+            key: (h.buckets, h.counts.copy(), h.sum, h.count) for key, h in _histograms.items()
+        }
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+
+    lines = []
+    typed = set()
+    for kind, metrics in [("counter", counters), ("gauge", gauges)]:
+        for (name, labels), value in sorted(metrics.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} {kind}")
+                typed.add(name)
+            lines.append(f"{name}{_labels(labels)} {_number(value)}")
+    for (name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        for bucket, cumulative in zip(buckets, np.cumsum(counts)):
+            bucket_labels = labels + (("le", _number(bucket)),)
+            lines.append(f"{name}_bucket{_labels(bucket_labels)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,162 @@
+"""
+Publish recommendation tables to the database
+
+A table is first loaded into a staging table with PostgreSQL COPY and
+indexed there. It then replaces the live table by renaming within one
+transaction, so readers never see a missing or partially filled table.
+"""
+
+import io
+
+import pandas as pd
+
+from mangoleaf import Connection
+
+
+def publish_table(df, table, key, column_types=None, lock_timeout="10s"):
+    """
+    Replace a table atomically with the contents of a DataFrame
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        New contents of the table. The index is not written
+
+    table : str
+        Name of the table to replace
+
+    key : str or list of str
+        Column or columns with unique values to index
+
+    column_types : dict, optional
+        SQL types of columns by name that are not to be inferred from
+        the DataFrame. Prepared statements on the table fail if the type
+        of a column they return changes, e.g. if an empty DataFrame
+        infers TEXT instead of BIGINT
+
+    lock_timeout : str, optional
+        Maximum time to wait for running queries on the live table
+        before the swap is aborted. Default is "10s"
+    """
+    staging = f"{table}_staging"
+
+    # Table definition as pandas.to_sql would create it
+    engine = Connection().get()
+    schema = pd.io.sql.get_schema(df, staging, con=engine)
+
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+
+        # Load and index the staging table
+        cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+        cursor.execute(schema)
+        for column, column_type in (column_types or dict()).items():
+            cursor.execute(
+                f'ALTER TABLE {staging} ALTER COLUMN "{column}" '
+                f'TYPE {column_type} USING "{column}"::{column_type}'
+            )
+        columns = ", ".join(f'"{column}"' for column in df.columns)
+        cursor.copy_expert(f"COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute(f"CREATE UNIQUE INDEX {staging}_key ON {staging} ({_columns(key)})")
+        cursor.execute(f"ANALYZE {staging}")
+        connection.commit()
+
+        _swap(cursor, table, lock_timeout)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def publish_query(select_query, table, key, lock_timeout="10s"):
+    """
+    Replace a table atomically with the result of a query
+
+    Parameters
+    ----------
+    select_query : str
+        SELECT query that produces the new contents of the table
+
+    table : str
+        Name of the table to replace
+
+    key : str or list of str
+        Column or columns with unique values to index
+
+    lock_timeout : str, optional
+        Maximum time to wait for running queries on the live table
+        before the swap is aborted. Default is "10s"
+    """
+    staging = f"{table}_staging"
+
+    connection = Connection().get().raw_connection()
+    try:
+        cursor = connection.cursor()
+
+        # Fill and index the staging table
+        cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+        cursor.execute(f"CREATE TABLE {staging} AS {select_query}")
+        cursor.execute(f"CREATE UNIQUE INDEX {staging}_key ON {staging} ({_columns(key)})")
+        cursor.execute(f"ANALYZE {staging}")
+        connection.commit()
+
+        _swap(cursor, table, lock_timeout)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def long_format(df, key):
+    """
+    Reshape recommendations to one row per recommended item
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Recommendations with a key column and one column per rank, as
+        returned by recommend.item_based and recommend.user_based
+
+    key : str
+        Column of the item or user the recommendations are for
+
+    Returns
+    -------
+    long : pd.DataFrame
+        Recommendations with the columns source_id, rank and item_id,
+        without empty ranks
+    """
+    long = df.rename(columns={key: "source_id"})
+    long = long.melt(id_vars="source_id", var_name="rank", value_name="item_id")
+    long = long.dropna(subset="item_id")
+    long = long.astype(dict(rank=int)).infer_objects()
+    long = long.sort_values(["source_id", "rank"], ignore_index=True)
+    return long
+
+
+def _columns(key):
+    """Quoted column list of one or more columns"""
+    if isinstance(key, str):
+        key = [key]
+    return ", ".join(f'"{column}"' for column in key)
+
+
+def _swap(cursor, table, lock_timeout):
+    """Rename the staging table over the live table, to be committed by the caller"""
+    staging = f"{table}_staging"
+    old = f"{table}_old"
+    cursor.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+    cursor.execute(f"DROP TABLE IF EXISTS {old}")
+    cursor.execute(f"ALTER TABLE IF EXISTS {table} RENAME TO {old}")
+    cursor.execute(f"ALTER TABLE {staging} RENAME TO {table}")
+    cursor.execute(f"DROP TABLE IF EXISTS {old}")
+    cursor.execute(f"ALTER INDEX {staging}_key RENAME TO {table}_key")
@@ -7,13 +7,68 @@ are then displayed in the streamlit app.
 """
 
 import bcrypt
-import pandas as pd
-from sqlalchemy.sql import text
 
-from mangoleaf import Connection
+from mangoleaf import Connection, catalog, search
+from mangoleaf.cache import TTLCache, VersionedCache
+from mangoleaf.metrics import timed
+from mangoleaf.statements import execute, read_frame, read_row, read_scalar
 
 
-def popularity(n, dataset, exclude_rated_by=None):
+@timed
+def recommendation_version(engine=None):
+    """
+    Get the version of the published recommendations
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine, optional
+        Engine to read the version from. Default is a read replica
+
+    Returns
+    -------
+    version : int
+        Version that is increased by every update of the recommendations
+    """
+    version = read_scalar("recommendation_version", engine=engine)
+    return version
+
+
+# Neighbor lists and popular items until the next update of the
+# recommendations, loaded from the replica the version was read from
+_cache = VersionedCache(recommendation_version, lambda: Connection().get_reader())
+
+# Explorer searches of the static catalogs for a while
+_search_cache = TTLCache(maxsize=1024, ttl=600)
+
+
+def _read_ids(name, dataset, engine=None, **params):
+    """Run a registered query for item_ids"""
+    return read_frame(name, dataset, engine, **params).item_id.to_list()
+
+
+def _read_items(name, dataset, **params):
+    """Run a registered query for item_ids and look up the items in the catalog"""
+    return catalog.get_items(dataset, _read_ids(name, dataset, **params))
+
+
+def _rated_among(user_id, dataset, item_ids, rated=None):
+    """Set of the item_ids that have been rated by a user"""
+    item_ids = list(item_ids)
+    if rated is not None:
+        return {item_id for item_id, r in zip(item_ids, rated.contains(dataset, item_ids)) if r}
+    if user_id is None or len(item_ids) == 0:
+        return set()
+    return set(_read_ids("rated_ids", dataset, user_id=user_id, item_ids=item_ids))
+
+
+def _top_items(item_ids, n, dataset, rated):
+    """Look up the first n item_ids that have not been rated"""
+    item_ids = [item_id for item_id in item_ids if item_id not in rated][:n]
+    return catalog.get_items(dataset, item_ids)
+
+
+@timed
+def popularity(n, dataset, exclude_rated_by=None, rated=None):
     """
     Popular books or mangas recommender.
 
@@ -28,25 +83,39 @@ def popularity(n, dataset, exclude_rated_by=None):
     exclude_rated_by : int, optional
         Exclude books or mangas that have been rated by this user
 
+    rated : ratings.RatedItems, optional
+        Rated items of the user to exclude instead of looking them up in
+        the database
+
     Returns
     -------
     pd.DataFrame
         DataFrame with the top n most popular books or mangas
     """
-    query = f"""
-    SELECT * FROM {dataset}_popular
-    INNER JOIN {dataset} USING(item_id)
-    WHERE item_id NOT IN (
-        SELECT item_id FROM {dataset}_ratings WHERE user_id = {exclude_rated_by or -1}
+    item_ids = _cache.get(
+        ("popular", dataset), lambda engine: _read_ids("popular_ids", dataset, engine)
     )
-    ORDER BY id
-    LIMIT {n};
-    """
-    df = pd.read_sql(query, Connection().get(), index_col="id")
+    rated = _rated_among(exclude_rated_by, dataset, item_ids, rated)
+    df = _top_items(item_ids, n, dataset, rated)
     return df
 
 
-def item_based(item_id, n, dataset, exclude_rated_by=None):
+def _neighbors(item_ids, dataset):
+    """Cached neighbor lists of several items by item_id"""
+
+    def load(keys, engine):
+        item_ids = [key[2] for key in keys]
+        df = read_frame("item_based_ids", dataset, engine, item_ids=item_ids)
+        neighbors = df.groupby("source_id").item_id.agg(list).to_dict()
+        return {key: neighbors.get(key[2], []) for key in keys}
+
+    keys = [("item_based", dataset, item_id) for item_id in item_ids]
+    neighbors = _cache.get_many(keys, load)
+    return {key[2]: neighbors[key] for key in keys}
+
+
+@timed
+def item_based(item_id, n, dataset, exclude_rated_by=None, rated=None):
     """
     Item-based collaborative filtering recommender.
 
@@ -64,33 +133,65 @@ def item_based(item_id, n, dataset, exclude_rated_by=None):
     exclude_rated_by : int, optional
         Exclude books or mangas that have been rated by this user
 
+    rated : ratings.RatedItems, optional
+        Rated items of the user to exclude instead of looking them up in
+        the database
+
     Returns
     -------
     pd.DataFrame
         DataFrame with the top n recommended books or mangas
     """
-    query = f"""
-    SELECT * FROM {dataset}_item_based
-    WHERE item_id = '{item_id}'
-    LIMIT 1;
+    item_ids = _neighbors([item_id], dataset)[item_id]
+    rated = _rated_among(exclude_rated_by, dataset, item_ids, rated)
+    df = _top_items(item_ids, n, dataset, rated)
+    return df
+
+
+@timed
+def item_based_batch(item_ids, n, dataset, exclude_rated_by=None, rated=None):
     """
-    item_ids = pd.read_sql(query, Connection().get(), index_col="item_id").squeeze().to_list()
+    Item-based collaborative filtering recommender for several items.
+
+    Parameters
+    ----------
+    item_ids : list
+        ISBNs or anime_ids of the books or mangas to base recommendations
+        on, in order of preference
+
+    n : int
+        Number of books or mangas to recommend per item
+
+    dataset : str
+        Dataset: "books" or "manga"
+
+    exclude_rated_by : int, optional
+        Exclude books or mangas that have been rated by this user
 
-    query = f"""
-    SELECT * FROM {dataset}
-    WHERE item_id IN ({", ".join([f"'{i}'" for i in item_ids])})
-    AND item_id NOT IN (
-        SELECT item_id FROM {dataset}_ratings
-        WHERE user_id = {exclude_rated_by or -1}
-    );
+    rated : ratings.RatedItems, optional
+        Rated items of the user to exclude instead of looking them up in
+        the database
+
+    Returns
+    -------
+    dict
+        DataFrames with the top n recommended books or mangas by item_id,
+        in the order of item_ids. Items without recommendations are left
+        out
     """
-    df = pd.read_sql(query, Connection().get(), index_col="item_id")
-    item_ids = [i for i in item_ids if i in df.index]
-    df = df.loc[item_ids].reset_index().head(n)
-    return df
+    neighbors = _neighbors(item_ids, dataset)
+    candidates = {item_id for neighbor_ids in neighbors.values() for item_id in neighbor_ids}
+    rated = _rated_among(exclude_rated_by, dataset, candidates, rated)
+    recommendations = dict()
+    for item_id, neighbor_ids in neighbors.items():
+        df = _top_items(neighbor_ids, n, dataset, rated)
+        if len(df) > 0:
+            recommendations[item_id] = df
+    return recommendations
 
 
-def user_based(user_id, n, dataset="books"):
+@timed
+def user_based(user_id, n, dataset="books", rated=None):
     """
     User-based collaborative filtering recommender.
 
@@ -105,31 +206,26 @@ def user_based(user_id, n, dataset="books"):
     dataset : str
         Dataset: "books" or "manga"
 
+    rated : ratings.RatedItems, optional
+        Rated items of the user to exclude instead of looking them up in
+        the database
+
     Returns
     -------
     pd.DataFrame
-        DataFrame with the top n recommended books or mangas
-    """
-    query = f"""
-    SELECT * FROM {dataset}_user_based
-    WHERE user_id = '{user_id}'
-    LIMIT 1;
+        DataFrame with the top n recommended books or mangas. Items the
+        user rated since the last update are left out
     """
-    item_ids = pd.read_sql(query, Connection().get(), index_col="user_id").squeeze()
-    if item_ids.empty:
-        return pd.DataFrame()
-    item_ids = item_ids.to_list()
-
-    query = f"""
-    SELECT * FROM {dataset}
-    WHERE item_id IN ({", ".join([f"'{i}'" for i in item_ids])});
-    """
-    df = pd.read_sql(query, Connection().get(), index_col="item_id")
-    item_ids = [i for i in item_ids if i in df.index]
-    df = df.loc[item_ids].reset_index().head(n)
+    item_ids = _cache.get(
+        ("user_based", dataset, user_id),
+        lambda engine: _read_ids("user_based_ids", dataset, engine, user_id=user_id),
+    )
+    rated = _rated_among(user_id, dataset, item_ids, rated)
+    df = _top_items(item_ids, n, dataset, rated)
     return df
 
 
+@timed
 def get_random_high_rated(user_id, dataset):
     """
     Get a random high rated book or manga from the user's history
@@ -147,19 +243,49 @@ def get_random_high_rated(user_id, dataset):
     pd.Series
         Item information of the random high rated book or manga
     """
-    query_user = f"WHERE user_id = {user_id}" if user_id is not None else ""
-    query = f"""
-    SELECT * FROM {dataset}_ratings
-    INNER JOIN {dataset} USING (item_id)
-    {query_user}
-    ORDER BY rating DESC, RANDOM()
-    LIMIT 10;
+    df = get_high_rated(user_id, dataset, 1).iloc[0]
+    return df
+
+
+@timed
+def get_high_rated(user_id, dataset, n=5):
     """
-    ratings = pd.read_sql(query, Connection().get())
-    df = ratings.sample(1).drop(columns=["user_id", "rating"]).iloc[0]
+    Get random high rated books or mangas from the user's history
+
+    The items are sampled from the seeds precomputed by the update job,
+    which are high rated items with recommendations. Without a user, the
+    items are sampled from the popular items with recommendations.
+
+    Parameters
+    ----------
+    user_id : int
+        ID of the user to get the books or mangas from
+
+    dataset : str
+        Dataset: "books" or "manga"
+
+    n : int, optional
+        Number of books or mangas to get. Default is 5
+
+    Returns
+    -------
+    pd.DataFrame
+        Item information of up to n random high rated books or mangas
+    """
+    if user_id is None:
+        df = _read_items("popular_seed_ids", dataset, n=n)
+    else:
+        # Only the few seed rows of the user are shuffled
+        df = _read_items("seed_ids", dataset, user_id=user_id, n=n)
+
+    # Users who started rating after the last update have no seeds yet
+    if len(df) == 0 and user_id is not None:
+        df = _read_items("high_rated_ids", dataset, user_id=user_id)
+        df = df.sample(min(n, len(df))).reset_index(drop=True)
     return df
 
 
+@timed
 def user_rating_exists(user_id, dataset):
     """
     Check if a user exists in the dataset
@@ -179,14 +305,11 @@ def user_rating_exists(user_id, dataset):
     """
     if user_id is None:
         return False
-    query = f"""
-    SELECT * FROM {dataset}_ratings
-    WHERE user_id = {user_id}
-    """
-    df = pd.read_sql(query, Connection().get())
-    return len(df) > 0
+    exists = read_scalar("user_rating_exists", dataset, user_id=user_id)
+    return exists
 
 
+@timed
 def user_exists(user_id):
     """
     Check if a user exists in the database
@@ -201,13 +324,11 @@ def user_exists(user_id):
     bool
         True if the user exists, False otherwise
     """
-    engine = Connection().get()
-    with engine.connect() as connection:
-        query = "SELECT * FROM users WHERE user_id = :user_id"
-        result = connection.execute(text(query), dict(user_id=user_id)).fetchone()
-    return result is not None
+    exists = read_scalar("user_exists", user_id=user_id)
+    return exists
 
 
+@timed
 def username_exists(username):
     """
     Check if a user exists in the database
@@ -222,13 +343,11 @@ def username_exists(username):
     bool
         True if the user exists, False otherwise
     """
-    engine = Connection().get()
-    with engine.connect() as connection:
-        query = "SELECT * FROM users WHERE username = :username"
-        result = connection.execute(text(query), dict(username=username)).fetchone()
-    return result is not None
+    exists = read_scalar("username_exists", username=username)
+    return exists
 
 
+@timed
 def match_user_credentials(username, password):
     """
     Check if username and password match credentials in database
@@ -243,24 +362,21 @@ def match_user_credentials(username, password):
 
     Returns
     -------
-    user_info : dict or None
+    user_info : statements.Row or None
         User information if the credentials match, None otherwise
     """
-    engine = Connection().get()
-    with engine.connect() as connection:
-        query = text("SELECT * FROM users WHERE username = :username")
-        result = connection.execute(query, dict(username=username)).fetchone()
+    user_info = read_row("user_by_username", username=username)
 
-        if result is None:
-            return None
+    if user_info is None:
+        return None
 
-        if not bcrypt.checkpw(password.encode("utf-8"), result.password.encode("utf-8")):
-            return None
+    if not bcrypt.checkpw(password.encode("utf-8"), user_info.password.encode("utf-8")):
+        return None
 
-        user_info = dict(result._mapping)
     return user_info
 
 
+@timed
 def next_user_id():
     """
     Get the next user ID to use
@@ -270,11 +386,11 @@ def next_user_id():
     user_id : int
         Next user ID
     """
-    query = "SELECT MAX(user_id) FROM users"
-    user_id = pd.read_sql(query, Connection().get()).iloc[0, 0]
+    user_id = read_scalar("next_user_id")
     return int(user_id) + 1 if user_id is not None else 0
 
 
+@timed
 def list_users_since(date):
     """
     List all active users in the database
@@ -289,15 +405,124 @@ def list_users_since(date):
     user_ids : pd.DataFrame
         DataFrame with all active users
     """
-    query = """
-    SELECT user_id FROM users
-    WHERE registered >= %(date)s
-    ORDER BY registered ASC
+    user_ids = read_frame("users_since", date=date).user_id.to_list()
+    return user_ids
+
+
+@timed
+def list_users(shard=0, shards=1):
     """
-    user_ids = pd.read_sql(query, Connection().get(), params=dict(date=date)).user_id.to_list()
+    List all registered users, optionally of one shard only
+
+    Parameters
+    ----------
+    shard : int, optional
+        Index of the shard to list the users of. Default is 0
+
+    shards : int, optional
+        Number of shards to split the users into by user_id. Default is
+        1 (all users)
+
+    Returns
+    -------
+    user_ids : list
+        user_ids of the shard in ascending order
+    """
+    user_ids = read_frame("users_of_shard", shard=shard, shards=shards).user_id.to_list()
     return user_ids
 
 
+@timed
+def database_time():
+    """
+    Get the current time of the database server
+
+    Returns
+    -------
+    now : datetime.datetime
+        Current timestamp of the database
+    """
+    now = read_scalar("database_time")
+    return now
+
+
+@timed
+def last_update():
+    """
+    Get the start time of the last successful recommendation update
+
+    Returns
+    -------
+    started : datetime.datetime or None
+        Start time of the last successful update, None if there was no
+        update since the last reset
+    """
+    started = read_scalar("last_update")
+    return started
+
+
+@timed
+def record_update(started, mode):
+    """
+    Record a successful recommendation update
+
+    Parameters
+    ----------
+    started : datetime.datetime
+        Database time at the start of the update
+
+    mode : {"full", "incremental"}
+        Mode of the update
+    """
+    engine = Connection().get()
+    with engine.connect() as connection:
+        execute(connection, "record_update", started=started, mode=mode)
+        connection.commit()
+
+
+@timed
+def bump_recommendation_version():
+    """
+    Mark the published recommendations as changed
+
+    Cached recommendations of the app are discarded once they notice the
+    new version.
+    """
+    engine = Connection().get()
+    with engine.connect() as connection:
+        execute(connection, "bump_recommendation_version")
+        connection.commit()
+
+
+@timed
+def list_rating_changes(dataset, since, until):
+    """
+    List the users and items with ratings written in a time range
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Dataset: "books" or "mangas"
+
+    since : datetime.datetime
+        Start of the time range (exclusive)
+
+    until : datetime.datetime
+        End of the time range (inclusive)
+
+    Returns
+    -------
+    user_ids : list
+        Users with changed ratings
+
+    item_ids : list
+        Items with changed ratings
+    """
+    changes = read_frame("rating_changes", dataset, since=since, until=until)
+    return changes.user_id.unique().tolist(), changes.item_id.unique().tolist()
+
+
+@timed
 def register_user(username, password):
     """
     Register a new user in the database
@@ -319,14 +544,14 @@ def register_user(username, password):
 
     engine = Connection().get()
     with engine.connect() as connection:
-        query = """
-        INSERT INTO users (user_id, username, password, full_name)
-        VALUES (:user_id, :username, :password, :username)
-        """
         salt = bcrypt.gensalt()
         hashed_password = bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
-        connection.execute(
-            text(query), dict(username=username, password=hashed_password, user_id=user_id)
+        execute(
+            connection,
+            "register_user",
+            user_id=user_id,
+            username=username,
+            password=hashed_password,
         )
         connection.commit()
 
@@ -334,6 +559,7 @@ def register_user(username, password):
     return username_exists(username) and user_exists(user_id)
 
 
+@timed
 def update_full_name(user_id, new_full_name):
     """
     Update the full name of a user in the database
@@ -353,12 +579,7 @@ def update_full_name(user_id, new_full_name):
     """
     engine = Connection().get()
     with engine.connect() as connection:
-        query = """
-        UPDATE users
-        SET full_name = :full_name
-        WHERE user_id = :user_id
-        """
-        connection.execute(text(query), dict(full_name=new_full_name, user_id=user_id))
+        execute(connection, "update_full_name", full_name=new_full_name, user_id=user_id)
         connection.commit()
 
     # Verify that the full name was updated
@@ -366,6 +587,7 @@ def update_full_name(user_id, new_full_name):
     return success
 
 
+@timed
 def update_password(user_id, new_password):
     """
     Update the password of a user in the database
@@ -388,12 +610,7 @@ def update_password(user_id, new_password):
 
     engine = Connection().get()
     with engine.connect() as connection:
-        query = """
-        UPDATE users
-        SET password = :password
-        WHERE user_id = :user_id
-        """
-        connection.execute(text(query), dict(password=hashed_password, user_id=user_id))
+        execute(connection, "update_password", password=hashed_password, user_id=user_id)
         connection.commit()
 
     # Verify that the password was updated
@@ -402,6 +619,7 @@ def update_password(user_id, new_password):
     return success
 
 
+@timed
 def delete_user(user_id):
     """
     Delete a user from the database
@@ -418,27 +636,22 @@ def delete_user(user_id):
     """
     engine = Connection().get()
     with engine.connect() as connection:
-        query = """
-        DELETE FROM user_data
-        WHERE user_id = :user_id;
-        DELETE FROM books_ratings
-        WHERE user_id = :user_id;
-        DELETE FROM mangas_ratings
-        WHERE user_id = :user_id;
-        DELETE FROM books_user_based
-        WHERE user_id = :user_id;
-        DELETE FROM mangas_user_based
-        WHERE user_id = :user_id;
-        DELETE FROM users
-        WHERE user_id = :user_id;
-        """
-        connection.execute(text(query), dict(user_id=user_id))
+        # Log the ratings as changed before they are deleted
+        for dataset in ["books", "mangas"]:
+            execute(connection, "log_user_rating_changes", dataset, user_id=user_id)
+        execute(connection, "delete_user_data", user_id=user_id)
+        for dataset in ["books", "mangas"]:
+            execute(connection, "delete_user_ratings", dataset, user_id=user_id)
+            execute(connection, "delete_user_based", dataset, user_id=user_id)
+            execute(connection, "delete_seeds", dataset, user_id=user_id)
+        execute(connection, "delete_user", user_id=user_id)
         connection.commit()
 
     # Verify that the user was deleted
     return not user_exists(user_id)
 
 
+@timed
 def get_user_info(user_id):
     """
     Get user information from the database
@@ -450,19 +663,16 @@ def get_user_info(user_id):
 
     Returns
     -------
-    user_info : dict
-        User information
+    user_info : statements.Row or dict
+        User information, an empty dict without a user
     """
     if user_id is None:
         return dict()
-    query = f"""
-    SELECT user_id, username, full_name FROM users
-    WHERE user_id = {user_id}
-    """
-    user_info = pd.read_sql(query, Connection().get()).iloc[0].to_dict()
+    user_info = read_row("user_info", user_id=user_id)
     return user_info
 
 
+@timed
 def get_extended_user_info(user_id):
     """
     Get extended user information from the database
@@ -474,20 +684,16 @@ def get_extended_user_info(user_id):
 
     Returns
     -------
-    user_info : dict
-        Extended user information
+    user_info : statements.Row or dict
+        Extended user information, an empty dict without a user
     """
     if user_id is None:
         return dict()
-    query = f"""
-    SELECT user_id, about, registered, image FROM users
-    LEFT JOIN user_data USING (user_id)
-    WHERE user_id = {user_id}
-    """
-    user_info = pd.read_sql(query, Connection().get()).iloc[0].to_dict()
+    user_info = read_row("extended_user_info", user_id=user_id)
     return user_info
 
 
+@timed
 def set_user_image(user_id, image):
     """
     Set the user image in the database
@@ -502,16 +708,11 @@ def set_user_image(user_id, image):
     """
     engine = Connection().get()
     with engine.connect() as connection:
-        query = """
-        INSERT INTO user_data (user_id, image)
-        VALUES (:user_id, :image)
-        ON CONFLICT (user_id) DO UPDATE
-        SET image = :image
-        """
-        connection.execute(text(query), dict(user_id=user_id, image=image))
+        execute(connection, "set_user_image", user_id=user_id, image=image)
         connection.commit()
 
 
+@timed
 def get_num_ratings(user_id):
     """
     Retrieve the number of ratings for a user
@@ -526,17 +727,11 @@ def get_num_ratings(user_id):
     num_ratings : int
         Number of ratings for the user
     """
-    query = f"""
-    SELECT COUNT(*) FROM books_ratings
-    WHERE user_id = {user_id}
-    UNION ALL
-    SELECT COUNT(*) FROM mangas_ratings
-    WHERE user_id = {user_id}
-    """
-    num_ratings = pd.read_sql(query, Connection().get()).sum().values[0]
+    num_ratings = read_scalar("num_ratings", user_id=user_id)
     return num_ratings
 
 
+@timed
 def update_rating(dataset, user_id, item_id, rating):
     """
     Update the rating of a book or manga in the database
@@ -554,19 +749,21 @@ def update_rating(dataset, user_id, item_id, rating):
 
     rating : {1, 2, 3, 4, 5}
         New rating for the book or manga
+
+    Notes
+    -----
+    The change is recorded in the rating change log to allow
+    incremental updates of the recommendations.
     """
     engine = Connection().get()
     with engine.connect() as connection:
-        query = f"""
-        INSERT INTO {dataset}_ratings (user_id, item_id, rating)
-        VALUES (:user_id, :item_id, :rating)
-        ON CONFLICT (user_id, item_id) DO UPDATE
-        SET rating = :rating
-        """
-        connection.execute(text(query), dict(user_id=user_id, item_id=item_id, rating=rating))
+        params = dict(user_id=user_id, item_id=item_id)
+        execute(connection, "update_rating", dataset, rating=rating, **params)
+        execute(connection, "log_rating_change", dataset, **params)
         connection.commit()
 
 
+@timed
 def export_user_data(user_id):
     """
     Get all user ratings from the database
@@ -581,23 +778,23 @@ def export_user_data(user_id):
     df : pd.DataFrame
         DataFrame with all user ratings
     """
-    query = f"""
-    SELECT item_id::text, 'book' as dataset, rating, title, author as secondary FROM books_ratings
-    LEFT JOIN books USING (item_id)
-    WHERE user_id = {user_id}
-    UNION ALL
-    SELECT item_id::text, 'manga' as dataset, rating, title, other_title as secondary
-        FROM mangas_ratings
-    LEFT JOIN mangas USING (item_id)
-    WHERE user_id = {user_id}
-    """
-    df = pd.read_sql(query, Connection().get())
+    df = read_frame("export_user_data", user_id=user_id)
     return df
 
 
-def get_filtered(dataset, n, user_id, where_query, query_params):
+def _hashable(value):
+    """Hashable form of a filter value for a cache key"""
+    return tuple(value) if isinstance(value, (list, tuple)) else value
+
+
+@timed
+def get_filtered(dataset, n, filters):
     """
-    Get filtered items with rating from the database
+    Get filtered items from the in-memory search of the catalog
+
+    The results of identical searches are cached and shared by all
+    users. They do not include the ratings of the user, which are
+    looked up separately with ratings.RatedItems.get_ratings.
 
     Parameters
     ----------
@@ -607,36 +804,16 @@ def get_filtered(dataset, n, user_id, where_query, query_params):
     n : int
         Number of items to load
 
-    user_id : int
-        ID of the user to load add the ratings for
-
-    where_query : str
-        WHERE query to filter the items
-
-    query_params : dict
-        Parameters for the WHERE query
+    filters : list of tuple
+        Filters of the items, see search.CatalogSearch.search
 
     Returns
     -------
     df : pd.DataFrame
-        DataFrame with the filtered items
-    """
-    if user_id is not None:
-        where_query = (
-            f"""
-        LEFT JOIN (
-            SELECT * FROM {dataset}_ratings
-            WHERE user_id = {user_id}
-        ) r USING (item_id)
-        """
-            + where_query
-        )
-
-    query_str = f"""
-    SELECT * FROM {dataset}
-    {where_query}
-    ORDER BY title
-    LIMIT {n};
+        DataFrame with the filtered items, the best matches of the text
+        filters first
     """
-    df = pd.read_sql(query_str, Connection().get(), params=query_params)
+    key = (dataset, n, tuple(tuple(map(_hashable, f)) for f in filters))
+    item_ids = _search_cache.get(key, lambda: search.search(dataset, filters, n))
+    df = catalog.get_items(dataset, item_ids)
     return df
@@ -0,0 +1,450 @@
+"""
+Load ratings into compact in-memory arrays
+
+The ratings of a dataset are held in CSR-style arrays sorted by user:
+int32 item indices, int8 ratings and row offsets per user. Raw user_ids
+and item_ids are interned, i.e. every distinct id is stored only once in
+a lookup table, instead of once per rating as in a DataFrame.
+"""
+
+import contextlib
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sqlalchemy.sql import text
+
+from mangoleaf import Connection
+
+
+class _Interner:
+    """Assign consecutive indices to raw ids in order of first appearance"""
+
+    def __init__(self):
+        self.lookup = dict()
+
+    def intern(self, raw_ids):
+        codes, uniques = pd.factorize(np.asarray(raw_ids))
+        mapping = np.fromiter(
+            (self.lookup.setdefault(raw_id, len(self.lookup)) for raw_id in uniques.tolist()),
+            dtype=np.int32,
+            count=len(uniques),
+        )
+        return mapping[codes]
+
+    def ids(self):
+        return pd.Index(list(self.lookup))
+
+
+class RatingsStore:
+    """
+    Ratings of one dataset in compact CSR-style arrays
+
+    Attributes
+    ----------
+    user_ids : pd.Index
+        Raw user_ids by inner user index
+
+    item_ids : pd.Index
+        Raw item_ids by inner item index
+
+    indptr : np.ndarray
+        Offsets of the ratings of each user, int64 of length
+        n_users + 1
+
+    item_index : np.ndarray
+        Inner item index of each rating, int32
+
+    ratings : np.ndarray
+        Rating values, int8
+    """
+
+    def __init__(self, user_ids, item_ids, indptr, item_index, ratings):
+        self.user_ids = pd.Index(user_ids)
+        self.item_ids = pd.Index(item_ids)
+        self.indptr = indptr
+        self.item_index = item_index
+        self.ratings = ratings
+
+    def __len__(self):
+        return len(self.ratings)
+
+    @property
+    def n_users(self):
+        return len(self.user_ids)
+
+    @property
+    def n_items(self):
+        return len(self.item_ids)
+
+    @property
+    def user_index(self):
+        """Inner user index of each rating"""
+        return np.repeat(np.arange(self.n_users, dtype=np.int32), np.diff(self.indptr))
+
+    @property
+    def nbytes(self):
+        """Memory of the rating arrays, without the id lookup tables"""
+        return self.indptr.nbytes + self.item_index.nbytes + self.ratings.nbytes
+
+    @classmethod
+    def from_indices(cls, user_ids, item_ids, user_index, item_index, ratings):
+        """
+        Create the store from ratings in any order
+
+        Parameters
+        ----------
+        user_ids : list-like
+            Raw user_ids by inner user index
+
+        item_ids : list-like
+            Raw item_ids by inner item index
+
+        user_index : np.ndarray
+            Inner user index of each rating
+
+        item_index : np.ndarray
+            Inner item index of each rating
+
+        ratings : np.ndarray
+            Rating values
+
+        Returns
+        -------
+        store : RatingsStore
+            Ratings sorted by user and item
+        """
+        user_index = np.asarray(user_index, dtype=np.int32)
+        item_index = np.asarray(item_index, dtype=np.int32)
+        order = np.lexsort((item_index, user_index))
+        counts = np.bincount(user_index, minlength=len(user_ids))
+        indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return cls(
+            user_ids,
+            item_ids,
+            indptr,
+            item_index[order],
+            np.asarray(ratings, dtype=np.int8)[order],
+        )
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Create the store from a DataFrame
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Ratings with the columns user_id, item_id and rating
+
+        Returns
+        -------
+        store : RatingsStore
+            Ratings of the DataFrame
+        """
+        user_index, user_ids = pd.factorize(df.user_id)
+        item_index, item_ids = pd.factorize(df.item_id)
+        return cls.from_indices(user_ids, item_ids, user_index, item_index, df.rating)
+
+    @classmethod
+    def load(cls, dataset, chunksize=100_000, connection=None):
+        """
+        Stream the ratings of a dataset from the database
+
+        The rows are fetched with a server-side cursor in chunks and
+        interned chunk by chunk, so the full table never exists as
+        Python objects.
+
+        Parameters
+        ----------
+        dataset : {"books", "mangas"}
+            Name of the dataset
+
+        chunksize : int, optional
+            Number of rows to fetch at once. Default is 100000
+
+        connection : sqlalchemy.engine.Connection, optional
+            Connection to read the ratings with, e.g. one in a snapshot
+            transaction. Default is a new connection to the primary
+            database
+
+        Returns
+        -------
+        store : RatingsStore
+            Ratings of the dataset
+        """
+        users = _Interner()
+        items = _Interner()
+        user_index, item_index, ratings = [], [], []
+
+        query = text(f"SELECT user_id, item_id, rating FROM {dataset}_ratings")
+        with contextlib.ExitStack() as stack:
+            if connection is None:
+                connection = stack.enter_context(Connection().get().connect())
+            result = connection.execute(query, execution_options=dict(stream_results=True))
+            for rows in result.partitions(chunksize):
+                user_chunk, item_chunk, rating_chunk = zip(*rows)
+                user_index.append(users.intern(user_chunk))
+                item_index.append(items.intern(item_chunk))
+                ratings.append(np.asarray(rating_chunk, dtype=np.int8))
+
+        if not ratings:
+            user_index = item_index = [np.zeros(0, dtype=np.int32)]
+            ratings = [np.zeros(0, dtype=np.int8)]
+        return cls.from_indices(
+            users.ids(),
+            items.ids(),
+            np.concatenate(user_index),
+            np.concatenate(item_index),
+            np.concatenate(ratings),
+        )
+
+    def to_matrix(self):
+        """
+        Sparse user x item rating matrix
+
+        Returns
+        -------
+        matrix : sp.csr_matrix
+            Ratings as float64 with users as rows and items as columns
+        """
+        return sp.csr_matrix(
+            (self.ratings.astype(np.float64), self.item_index, self.indptr),
+            shape=(self.n_users, self.n_items),
+        )
+
+    def to_frame(self):
+        """
+        Ratings as a DataFrame
+
+        Returns
+        -------
+        df : pd.DataFrame
+            Ratings with the columns user_id, item_id and rating
+        """
+        return pd.DataFrame(
+            dict(
+                user_id=self.user_ids[self.user_index],
+                item_id=self.item_ids[self.item_index],
+                rating=self.ratings,
+            )
+        )
+
+
+class RatedItems:
+    """
+    Ratings of one user in sorted arrays per dataset
+
+    Meant to be kept for the session of a logged in user, so that the
+    rated items do not need to be queried on every page view.
+
+    Attributes
+    ----------
+    item_ids : dict
+        Sorted array of the rated item_ids by dataset
+
+    ratings : dict
+        Array of the ratings in the order of item_ids by dataset
+    """
+
+    def __init__(self, item_ids=None, ratings=None):
+        self.item_ids = item_ids or dict()
+        self.ratings = ratings or dict()
+
+    @classmethod
+    def load(cls, user_id, datasets=("books", "mangas")):
+        """
+        Load the ratings of a user from the database
+
+        Parameters
+        ----------
+        user_id : int
+            ID of the user
+
+        datasets : tuple of str, optional
+            Datasets to load the ratings of. Default is books and mangas
+
+        Returns
+        -------
+        rated : RatedItems
+            Ratings of the user
+        """
+        rated = cls()
+        with Connection().get().connect() as connection:
+            for dataset in datasets:
+                query = text(f"SELECT item_id, rating FROM {dataset}_ratings WHERE user_id = :id")
+                rows = connection.execute(query, dict(id=user_id)).all()
+                if rows:
+                    item_ids, ratings = zip(*rows)
+                    rated._assign(dataset, np.asarray(item_ids), np.asarray(ratings, np.int8))
+        return rated
+
+    def _assign(self, dataset, item_ids, ratings):
+        order = np.argsort(item_ids, kind="stable")
+        self.item_ids[dataset] = item_ids[order]
+        self.ratings[dataset] = ratings[order]
+
+    def count(self, dataset=None):
+        """
+        Number of rated items
+
+        Parameters
+        ----------
+        dataset : {"books", "mangas"}, optional
+            Dataset to count the ratings of. Default is all datasets
+
+        Returns
+        -------
+        count : int
+            Number of rated items
+        """
+        if dataset is None:
+            return sum(len(item_ids) for item_ids in self.item_ids.values())
+        return len(self.item_ids.get(dataset, ()))
+
+    def _positions(self, dataset, item_ids):
+        """Insert positions of item_ids and whether they are rated"""
+        rated = self.item_ids.get(dataset)
+        item_ids = np.asarray(item_ids)
+        if rated is None or len(item_ids) == 0:
+            return np.zeros(len(item_ids), dtype=int), np.zeros(len(item_ids), dtype=bool)
+        dtype = np.promote_types(rated.dtype, item_ids.dtype)
+        rated, item_ids = rated.astype(dtype), item_ids.astype(dtype)
+        positions = np.searchsorted(rated, item_ids)
+        found = rated[np.minimum(positions, len(rated) - 1)] == item_ids
+        return positions, found
+
+    def contains(self, dataset, item_ids):
+        """
+        Check which items have been rated
+
+        Parameters
+        ----------
+        dataset : {"books", "mangas"}
+            Dataset of the items
+
+        item_ids : list-like
+            item_ids to check
+
+        Returns
+        -------
+        rated : np.ndarray
+            Boolean mask of the rated item_ids
+        """
+        return self._positions(dataset, list(item_ids))[1]
+
+    def rating(self, dataset, item_id):
+        """
+        Rating of an item
+
+        Parameters
+        ----------
+        dataset : {"books", "mangas"}
+            Dataset of the item
+
+        item_id : int or str
+            item_id of the item
+
+        Returns
+        -------
+        rating : int or None
+            Rating of the item, None if it has not been rated
+        """
+        positions, found = self._positions(dataset, [item_id])
+        if not found[0]:
+            return None
+        return int(self.ratings[dataset][positions[0]])
+
+    def get_ratings(self, dataset, item_ids):
+        """
+        Ratings of several items
+
+        Parameters
+        ----------
+        dataset : {"books", "mangas"}
+            Dataset of the items
+
+        item_ids : list-like
+            item_ids of the items
+
+        Returns
+        -------
+        ratings : np.ndarray
+            Rating of each item, NaN if it has not been rated
+        """
+        positions, found = self._positions(dataset, list(item_ids))
+        ratings = np.full(len(found), np.nan)
+        if found.any():
+            ratings[found] = self.ratings[dataset][positions[found]]
+        return ratings
+
+    def between(self, dataset, low, high, invert=False):
+        """
+        Items with a rating in a range
+
+        Parameters
+        ----------
+        dataset : {"books", "mangas"}
+            Dataset of the items
+
+        low, high : int
+            Lowest and highest rating of the range
+
+        invert : bool, optional
+            Whether to get the rated items outside of the range instead.
+            Default is False
+
+        Returns
+        -------
+        item_ids : list
+            Sorted item_ids of the items
+        """
+        if dataset not in self.item_ids:
+            return []
+        ratings = self.ratings[dataset]
+        inside = (ratings >= low) & (ratings <= high)
+        return self.item_ids[dataset][inside != invert].tolist()
+
+    def set_rating(self, dataset, item_id, rating):
+        """
+        Add or update the rating of an item in place
+
+        Parameters
+        ----------
+        dataset : {"books", "mangas"}
+            Dataset of the item
+
+        item_id : int or str
+            item_id of the item
+
+        rating : int
+            New rating of the item
+        """
+        positions, found = self._positions(dataset, [item_id])
+        if found[0]:
+            self.ratings[dataset][positions[0]] = rating
+            return
+        item_ids = self.item_ids.get(dataset, np.asarray([], dtype=np.asarray([item_id]).dtype))
+        ratings = self.ratings.get(dataset, np.zeros(0, dtype=np.int8))
+        # Widen string arrays for longer item_ids
+        dtype = np.promote_types(item_ids.dtype, np.asarray([item_id]).dtype)
+        self.item_ids[dataset] = np.insert(item_ids.astype(dtype), positions[0], item_id)
+        self.ratings[dataset] = np.insert(ratings, positions[0], rating)
+
+    def remove(self, dataset, item_id):
+        """
+        Remove the rating of an item in place
+
+        Parameters
+        ----------
+        dataset : {"books", "mangas"}
+            Dataset of the item
+
+        item_id : int or str
+            item_id of the item
+        """
+        positions, found = self._positions(dataset, [item_id])
+        if found[0]:
+            self.item_ids[dataset] = np.delete(self.item_ids[dataset], positions[0])
+            self.ratings[dataset] = np.delete(self.ratings[dataset], positions[0])
@@ -2,14 +2,16 @@
 Generate recommendations based on collaborative filtering
 """
 
+import numpy as np
 import pandas as pd
 from surprise import Dataset, KNNBaseline, Reader
 from tqdm import tqdm
 
-from mangoleaf import Connection
+from mangoleaf import Connection, artifacts, knn
+from mangoleaf.ratings import RatingsStore
 
 
-def popularity(dataset, n=40, count_threshold=50):
+def popularity(dataset, n=40, count_threshold=50, ratings=None, catalog=None):
     """
     Generate the most popular items based on ratings
 
@@ -25,25 +27,45 @@ def popularity(dataset, n=40, count_threshold=50):
         Minimum number of ratings a item must have to be considered.
         Default is 50
 
+    ratings : RatingsStore, optional
+        Ratings to aggregate in memory. Default is to aggregate the
+        ratings in the database
+
+    catalog : pd.DataFrame, optional
+        Items of the dataset with an item_id column to use with the
+        ratings instead of loading the candidates from the database
+
     Returns
     -------
     popular : pd.DataFrame
         DataFrame containing the item_ids of the most popular items
     """
-    db_engine = Connection().get()
-
-    # Query the most popular items
-    query = f"""
-    SELECT * FROM {dataset} b
-    RIGHT JOIN (
-        SELECT item_id, AVG(rating) FROM {dataset}_ratings
-        GROUP BY item_id
-        HAVING COUNT(rating) > {count_threshold}
-    ) as m USING (item_id)
-    ORDER BY avg DESC
-    LIMIT {n * 2};
-    """
-    popular = pd.read_sql(query, db_engine).drop(columns="avg")
+    if ratings is None:
+        # Query the most popular items
+        query = f"""
+        SELECT * FROM {dataset} b
+        RIGHT JOIN (
+            SELECT item_id, AVG(rating) FROM {dataset}_ratings
+            GROUP BY item_id
+            HAVING COUNT(rating) > {count_threshold}
+        ) as m USING (item_id)
+        ORDER BY avg DESC
+        LIMIT {n * 2};
+        """
+        popular = pd.read_sql(query, Connection().get()).drop(columns="avg")
+    else:
+        # Aggregate in memory and load only the candidates from the catalog
+        count = np.bincount(ratings.item_index, minlength=ratings.n_items)
+        total = np.bincount(ratings.item_index, weights=ratings.ratings, minlength=ratings.n_items)
+        average = np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+        candidates = np.flatnonzero(count > count_threshold)
+        candidates = candidates[np.argsort(-average[candidates], kind="stable")][: n * 2]
+        item_ids = ratings.item_ids[candidates].tolist()
+
+        if catalog is None:
+            query = f"SELECT * FROM {dataset} WHERE item_id = ANY(%(item_ids)s)"
+            catalog = pd.read_sql(query, Connection().get(), params=dict(item_ids=item_ids))
+        popular = pd.DataFrame(dict(item_id=item_ids)).merge(catalog, "left", on="item_id")
 
     # Make the selection diverse by selecting only one item per author
     if "author" in popular.columns:
@@ -57,7 +79,23 @@ def popularity(dataset, n=40, count_threshold=50):
     return popular
 
 
-def item_based(dataset, n=40):
+def _load_model(dataset, k, block_size, ratings=None):
+    """Fit a model on the given ratings or use the stored model of the dataset"""
+    if ratings is None:
+        return artifacts.load_or_fit(dataset, k, block_size)
+    return artifacts.Model.fit(dataset, ratings, k=k, block_size=block_size)
+
+
+def _load_frame(dataset, ratings=None):
+    """Ratings as a DataFrame for surprise"""
+    if ratings is None:
+        ratings = RatingsStore.load(dataset)
+    return ratings.to_frame()
+
+
+def item_based(
+    dataset, n=40, engine="native", block_size=1024, model=None, items=None, ratings=None
+):
     """
     Generate item-based recommendations for each item
 
@@ -69,13 +107,42 @@ def item_based(dataset, n=40):
     n : int, optional
         Number of items to recommend. Default is 40
 
+    engine : {"native", "surprise"}, optional
+        Implementation of the pearson_baseline k-NN model. "native"
+        computes the neighbors of all items at once on sparse matrices,
+        "surprise" fits the surprise KNNBaseline model. Default is
+        "native"
+
+    block_size : int, optional
+        Number of items to compute the similarities for at once with the
+        native engine. Default is 1024
+
+    model : artifacts.Model, optional
+        Fitted model to use with the native engine. Default is the
+        stored model of the current ratings, see artifacts.load_or_fit
+
+    items : list, optional
+        List of item_ids to generate recommendations for. Default is all
+        rated items
+
+    ratings : RatingsStore, optional
+        Ratings to fit the model on instead of loading them from the
+        database. Ignored if a model is given
+
     Returns
     -------
     item_based : pd.DataFrame
         DataFrame containing recommended item_ids for all item_ids
     """
+    if engine == "native":
+        if model is None:
+            model = _load_model(dataset, max(n, 40), block_size, ratings)
+        return _item_based_native(model, n, items)
+    elif engine != "surprise":
+        raise ValueError(f"Unknown engine: {engine}")
+
     # Load all the ratings
-    ratings = pd.read_sql(f"SELECT * FROM {dataset}_ratings", Connection().get())
+    ratings = _load_frame(dataset, ratings)
 
     # Load data into surprise
     reader = Reader(rating_scale=(1, 5))
@@ -95,8 +162,12 @@ def item_based(dataset, n=40):
     algo.fit(full_train)
 
     # Get the top nearest neighbors
+    item_ids = ratings.item_id.unique()
+    if items is not None:
+        rated = set(item_ids)
+        item_ids = [item_id for item_id in items if item_id in rated]
     item_list = dict()
-    for item_id in tqdm(ratings.item_id.unique()):
+    for item_id in tqdm(item_ids):
         inner_id = algo.trainset.to_inner_iid(item_id)
         neighbors = algo.get_neighbors(inner_id, k=n)
         item_list[item_id] = [algo.trainset.to_raw_iid(inner_id) for inner_id in neighbors]
@@ -105,7 +176,25 @@ def item_based(dataset, n=40):
     return item_based
 
 
-def user_based(dataset, users, n=40):
+def _item_based_native(model, n, items=None):
+    """Nearest neighbors of all or the selected items from the fitted model"""
+    if n > model.k:
+        raise ValueError(f"Model has only {model.k} neighbors per item, {n} requested")
+    rows = np.arange(len(model.item_ids))
+    if items is not None:
+        rows = model.item_ids.get_indexer(pd.Index(items))
+        rows = rows[rows >= 0]
+    neighbors = model.item_neighbors[rows, :n]
+
+    # Translate inner indices back to raw item_ids
+    raw_ids = np.asarray(model.item_ids, dtype=object)
+    neighbor_ids = np.where(neighbors >= 0, raw_ids[neighbors], None)
+    item_based = pd.DataFrame(neighbor_ids, index=raw_ids[rows], columns=range(n))
+    item_based = item_based.reset_index(names="item_id")
+    return item_based
+
+
+def user_based(dataset, users, n=40, engine="native", block_size=1024, model=None, ratings=None):
     """
     Generate user-based recommendations selected users
 
@@ -120,13 +209,40 @@ def user_based(dataset, users, n=40):
     n : int, optional
         Number of items to recommend. Default is 40
 
+    engine : {"native", "surprise"}, optional
+        Implementation of the pearson_baseline k-NN model. "native"
+        scores all unrated items of a block of users at once from each
+        user's nearest neighbors, "surprise" predicts every unrated
+        (user, item) pair with the surprise KNNBaseline model. Default
+        is "native"
+
+    block_size : int, optional
+        Number of users to compute the similarities for and to score at
+        once with the native engine. Sets the peak memory of the native
+        engine. Default is 1024
+
+    model : artifacts.Model, optional
+        Fitted model to use with the native engine. Default is the
+        stored model of the current ratings, see artifacts.load_or_fit
+
+    ratings : RatingsStore, optional
+        Ratings to fit the model on instead of loading them from the
+        database. Ignored if a model is given
+
     Returns
     -------
     user_based : pd.DataFrame
         DataFrame containing recommended item_ids for selected user_ids
     """
+    if engine == "native":
+        if model is None:
+            model = _load_model(dataset, max(n, 40), block_size, ratings)
+        return _user_based_native(model, users, n, block_size)
+    elif engine != "surprise":
+        raise ValueError(f"Unknown engine: {engine}")
+
     # Load all the ratings
-    ratings = pd.read_sql(f"SELECT * FROM {dataset}_ratings", Connection().get())
+    ratings = _load_frame(dataset, ratings)
 
     # Load data into surprise
     reader = Reader(rating_scale=(1, 5))
@@ -160,3 +276,31 @@ def user_based(dataset, users, n=40):
 
     user_based = pd.DataFrame(user_list).T.reset_index(names="user_id")
     return user_based
+
+
+def _user_based_native(model, users, n, block_size, k=40):
+    """Top-n unrated items of the selected users from the fitted user-user model"""
+    # Users without ratings cannot be scored
+    users = pd.unique(pd.Series(users))
+    inner = model.user_ids.get_indexer(users)
+    users, inner = users[inner >= 0], inner[inner >= 0]
+
+    items = knn.predict_top_n(
+        model.matrix,
+        model.global_mean,
+        model.bu,
+        model.bi,
+        model.user_neighbors[:, :k],
+        model.user_similarities[:, :k],
+        inner,
+        n,
+        block_size=block_size,
+    )
+
+    # Users that rated every item have no recommendations
+    keep = (items >= 0).any(axis=1)
+    raw_ids = np.asarray(model.item_ids, dtype=object)
+    recommended_ids = np.where(items[keep] >= 0, raw_ids[items[keep]], None)
+    user_based = pd.DataFrame(recommended_ids, index=users[keep], columns=range(n))
+    user_based = user_based.reset_index(names="user_id")
+    return user_based
@@ -0,0 +1,323 @@
+"""
+Search the item catalogs in memory
+
+The explorer filters are evaluated on the in-memory catalogs instead of
+scanning the tables with ILIKE. Text columns get an inverted index of
+their lower-cased words, built in the background when the explorer is
+opened, see warm_up. A search term matches the items whose text
+contains it, ignoring the case, like ILIKE did. The index narrows the
+items down to those that contain the words of the term, and only these
+are checked for the term itself. Short words occur in most items, so
+all items are checked then. Terms without any words, e.g. only
+punctuation, match nothing. The items are ranked by how well they
+match.
+"""
+
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+from mangoleaf import catalog
+
+_indexes = dict()
+_lock = threading.Lock()
+_warming = set()
+
+_word = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Lower-cased words of a text"""
+    return _word.findall(str(text).lower())
+
+
+class TextIndex:
+    """
+    Inverted index of the words of one text column
+
+    Parameters
+    ----------
+    values : array-like
+        Text of each row, None or NaN for missing values
+
+    Attributes
+    ----------
+    vocabulary : np.ndarray
+        Sorted unique words
+
+    codes : np.ndarray
+        Position in the vocabulary of the word of each entry of rows
+
+    rows : np.ndarray
+        Rows of each word, grouped by word in the order of the
+        vocabulary
+
+    offsets : np.ndarray
+        Start of the rows of each word in rows, with the total number
+        of rows appended
+
+    lower : np.ndarray
+        Lower-cased text of each row, as Python strings
+
+    text : np.ndarray
+        Lower-cased words of each row separated by single spaces, as
+        Python strings
+    """
+
+    # Share of the rows above which the candidates of a term are not
+    # narrowed down by the index, but all rows are checked
+    scan_share = 0.5
+
+    def __init__(self, values):
+        text = pd.Series(np.asarray(values, dtype=object)).fillna("").astype(str).str.lower()
+        words = text.str.findall(_word.pattern)
+        pairs = words.explode().dropna().reset_index().drop_duplicates()
+        pairs.columns = ["row", "word"]
+        codes, vocabulary = pd.factorize(pairs.word, sort=True)
+        order = np.argsort(codes, kind="stable")
+
+        # Object arrays, fixed-width strings would pad every row to the
+        # longest one
+        self.n_rows = len(text)
+        self.vocabulary = np.asarray(vocabulary, dtype=object)
+        self.codes = codes[order]
+        self.rows = pairs.row.to_numpy()[order]
+        self.offsets = np.searchsorted(self.codes, np.arange(len(self.vocabulary) + 1))
+        self.lower = text.to_numpy(dtype=object)
+        self.text = words.str.join(" ").to_numpy(dtype=object)
+
+        # The vocabulary as one string, to find the words that contain a
+        # word with a single search instead of one per word
+        self._joined = "\n".join(self.vocabulary)
+        lengths = pd.Series(self.vocabulary, dtype=object).str.len().to_numpy() + 1
+        self._starts = np.cumsum(lengths) - lengths
+
+    def _containing(self, word):
+        """Positions in the vocabulary of the words that contain a word"""
+        positions = [match.start() for match in re.finditer(re.escape(word), self._joined)]
+        return np.unique(np.searchsorted(self._starts, positions, side="right") - 1)
+
+    def _rows_of(self, words):
+        """Rows of several words given by their positions in the vocabulary"""
+        starts, stops = self.offsets[words], self.offsets[words + 1]
+        lengths = stops - starts
+        shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self.rows[shifts + np.arange(lengths.sum())]
+
+    def match(self, term):
+        """
+        Find and score the rows whose text contains a search term
+
+        Parameters
+        ----------
+        term : str
+            Search term
+
+        Returns
+        -------
+        rows : np.ndarray
+            Sorted rows that contain the term, none if the term has no
+            words
+
+        score : np.ndarray
+            Relevance of each of the rows: per word 3 for a whole word,
+            2 for a prefix and 1 for a part of a word, plus 2 if the
+            text starts with the words of the term and 4 if it equals
+            them
+        """
+        words = tokenize(term)
+        if not words:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        # Positions in the vocabulary of the prefixes and of the word
+        ranges = []
+        for word in words:
+            start = np.searchsorted(self.vocabulary, word)
+            stop = np.searchsorted(self.vocabulary, word + "\U0010ffff")
+            whole = start < len(self.vocabulary) and self.vocabulary[start] == word
+            ranges.append((start, stop, start + int(whole)))
+
+        # Inside the term, the first word ends a word of the text, the
+        # last word starts one and all words in between are whole words.
+        # Short words occur in most rows, so all rows are checked then
+        rows = self._rows_of(self._containing(words[0]))
+        if len(rows) > self.scan_share * self.n_rows:
+            rows = np.arange(self.n_rows)
+        else:
+            rows = np.unique(rows)
+            for i, (start, stop, whole) in enumerate(ranges[1:], start=1):
+                last = stop if i == len(words) - 1 else whole
+                rows = np.intersect1d(rows, self.rows[self.offsets[start] : self.offsets[last]])
+
+        # Only the candidates are checked for the term itself
+        term = term.lower()
+        found = np.fromiter((term in text for text in self.lower[rows]), bool, len(rows))
+        rows = rows[found]
+
+        # Mark the rows with the word as a prefix or whole word
+        score = np.zeros(len(rows))
+        marks = np.zeros(self.n_rows, dtype=np.int8)
+        for start, stop, whole in ranges:
+            marks[:] = 1
+            marks[self.rows[self.offsets[start] : self.offsets[stop]]] = 2
+            marks[self.rows[self.offsets[start] : self.offsets[whole]]] = 3
+            score += marks[rows]
+        phrase, text = " ".join(words), pd.Series(self.text[rows], dtype=object)
+        score += 2 * text.str.startswith(phrase).to_numpy() + 4 * (text == phrase).to_numpy()
+        return rows, score
+
+
+class CatalogSearch:
+    """
+    Evaluate explorer filters on the catalog of a dataset
+
+    Parameters
+    ----------
+    items : catalog.Catalog
+        Items to search
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self._text_indexes = dict()
+        self._lock = threading.Lock()
+
+        # Position of each item when ordered by title
+        titles = np.asarray(items.arrays["title"], dtype=object).astype(str)
+        self.title_rank = np.empty(len(titles), dtype=np.int64)
+        self.title_rank[np.argsort(titles, kind="stable")] = np.arange(len(titles))
+
+    def text_index(self, column):
+        """Inverted index of a text column, built on first use"""
+        index = self._text_indexes.get(column)
+        if index is None:
+            with self._lock:
+                index = self._text_indexes.get(column)
+                if index is None:
+                    index = TextIndex(self.items.arrays[column])
+                    self._text_indexes[column] = index
+        return index
+
+    def search(self, filters, n):
+        """
+        Find the items that pass all filters
+
+        Parameters
+        ----------
+        filters : list of tuple
+            Filters as (kind, column, *values) with the kinds
+            "text" (term), "contains" (term, not ranked), "between"
+            (low, high), "in" (list of values) and "not_in" (list of
+            values)
+
+        n : int
+            Maximum number of items
+
+        Returns
+        -------
+        item_ids : list
+            item_ids of up to n items, the best matches of the text
+            filters first, then by title
+        """
+        matched = np.ones(len(self.items), dtype=bool)
+        score = np.zeros(len(self.items))
+        for kind, column, *values in filters:
+            if kind in ("text", "contains"):
+                rows, text_score = self.text_index(column).match(values[0])
+                text_matched = np.zeros(len(self.items), dtype=bool)
+                text_matched[rows] = True
+                matched &= text_matched
+                if kind == "text":
+                    score[rows] += text_score
+            elif kind == "between":
+                column_values = np.asarray(self.items.arrays[column], dtype=float)
+                matched &= (column_values >= values[0]) & (column_values <= values[1])
+            elif kind in ("in", "not_in"):
+                isin = np.isin(self.items.index, np.asarray(values[0]))
+                matched &= isin if kind == "in" else ~isin
+            else:
+                raise ValueError(f"Unknown filter {kind}")
+
+        rows = np.flatnonzero(matched)
+        rows = rows[np.lexsort((self.title_rank[rows], -score[rows]))][:n]
+        return self.items.index[rows].to_list()
+
+
+def get_search(dataset):
+    """
+    Get the search of a dataset, creating it on first use
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    Returns
+    -------
+    search : CatalogSearch
+        Search of the catalog of the dataset
+    """
+    search = _indexes.get(dataset)
+    if search is None:
+        with _lock:
+            search = _indexes.get(dataset)
+            if search is None:
+                search = CatalogSearch(catalog.get_catalog(dataset))
+                _indexes[dataset] = search
+    return search
+
+
+def warm_up(dataset, columns):
+    """
+    Build the search of a dataset and the indexes of columns in the background
+
+    Building an index takes seconds, so it is started before the first
+    search, e.g. when the explorer is opened. A search of a column whose
+    index is still being built waits for it. Each dataset and set of
+    columns is only built once per process.
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    columns : list of str
+        Text columns to index
+    """
+    key = (dataset, tuple(columns))
+    with _lock:
+        if key in _warming:
+            return
+        _warming.add(key)
+
+    def build():
+        search = get_search(dataset)
+        for column in columns:
+            search.text_index(column)
+
+    threading.Thread(target=build, name=f"warm_up_{dataset}", daemon=True).start()
+
+
+def search(dataset, filters, n):
+    """
+    Find the items of a dataset that pass all filters
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    filters : list of tuple
+        Filters, see CatalogSearch.search
+
+    n : int
+        Maximum number of items
+
+    Returns
+    -------
+    item_ids : list
+        item_ids of up to n items in the order of relevance
+    """
+    return get_search(dataset).search(filters, n)
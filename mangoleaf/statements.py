@@ -0,0 +1,377 @@
+"""
+Named, parameterized statements of the queries
+
+Every query of mangoleaf.query is registered here once by name, with
+bound parameters written as :name. Statements that refer to a dataset
+are generated for each dataset up front. A statement is prepared on the
+database server the first time it runs on a pooled connection and
+executed by name from then on, so that PostgreSQL parses and plans it
+only once per connection.
+"""
+
+import re
+
+import pandas as pd
+
+from mangoleaf import Connection
+
+# Type of the item_ids of each dataset
+DATASETS = dict(books="VARCHAR", mangas="INTEGER")
+
+STATEMENTS = dict(
+    # Recommendations
+    recommendation_version="SELECT version FROM recommendation_version",
+    popular_ids="SELECT item_id FROM {dataset}_popular ORDER BY id",
+    item_based_ids="""
+        SELECT source_id, item_id FROM {dataset}_item_based
+        WHERE source_id = ANY(:item_ids::{item_type}[])
+        ORDER BY source_id, rank
+    """,
+    user_based_ids="""
+        SELECT item_id FROM {dataset}_user_based
+        WHERE source_id = :user_id
+        ORDER BY rank
+    """,
+    popular_seed_ids="""
+        SELECT p.item_id FROM {dataset}_popular p
+        WHERE EXISTS (
+            SELECT 1 FROM {dataset}_item_based r WHERE r.source_id = p.item_id
+        )
+        ORDER BY RANDOM()
+        LIMIT :n
+    """,
+    seed_ids="""
+        SELECT item_id FROM {dataset}_seeds
+        WHERE user_id = :user_id
+        ORDER BY RANDOM()
+        LIMIT :n
+    """,
+    high_rated_ids="""
+        SELECT item_id FROM {dataset}_ratings
+        WHERE user_id = :user_id
+        ORDER BY rating DESC, RANDOM()
+        LIMIT 10
+    """,
+    # Ratings
+    rated_ids="""
+        SELECT item_id FROM {dataset}_ratings
+        WHERE user_id = :user_id AND item_id = ANY(:item_ids::{item_type}[])
+    """,
+    user_rating_exists="""
+        SELECT EXISTS (
+            SELECT 1 FROM {dataset}_ratings WHERE user_id = :user_id
+        )
+    """,
+    num_ratings="""
+        SELECT (SELECT COUNT(*) FROM books_ratings WHERE user_id = :user_id)
+            + (SELECT COUNT(*) FROM mangas_ratings WHERE user_id = :user_id)
+    """,
+    update_rating="""
+        INSERT INTO {dataset}_ratings (user_id, item_id, rating)
+        VALUES (:user_id, :item_id, :rating)
+        ON CONFLICT (user_id, item_id) DO UPDATE
+        SET rating = :rating
+    """,
+    log_rating_change="""
+        INSERT INTO {dataset}_rating_changes (user_id, item_id)
+        VALUES (:user_id, :item_id)
+    """,
+    log_user_rating_changes="""
+        INSERT INTO {dataset}_rating_changes (user_id, item_id)
+        SELECT user_id, item_id FROM {dataset}_ratings
+        WHERE user_id = :user_id
+    """,
+    delete_user_ratings="DELETE FROM {dataset}_ratings WHERE user_id = :user_id",
+    delete_user_based="DELETE FROM {dataset}_user_based WHERE source_id = :user_id",
+    delete_seeds="DELETE FROM {dataset}_seeds WHERE user_id = :user_id",
+    export_user_data="""
+        SELECT item_id::text, 'book' as dataset, rating, title, author as secondary
+            FROM books_ratings
+        LEFT JOIN books USING (item_id)
+        WHERE user_id = :user_id
+        UNION ALL
+        SELECT item_id::text, 'manga' as dataset, rating, title, other_title as secondary
+            FROM mangas_ratings
+        LEFT JOIN mangas USING (item_id)
+        WHERE user_id = :user_id
+    """,
+    # Users
+    user_exists="SELECT EXISTS (SELECT 1 FROM users WHERE user_id = :user_id)",
+    username_exists="SELECT EXISTS (SELECT 1 FROM users WHERE username = :username)",
+    user_by_username="SELECT * FROM users WHERE username = :username",
+    next_user_id="SELECT MAX(user_id) FROM users",
+    register_user="""
+        INSERT INTO users (user_id, username, password, full_name)
+        VALUES (:user_id, :username, :password, :username)
+    """,
+    update_full_name="UPDATE users SET full_name = :full_name WHERE user_id = :user_id",
+    update_password="UPDATE users SET password = :password WHERE user_id = :user_id",
+    delete_user_data="DELETE FROM user_data WHERE user_id = :user_id",
+    delete_user="DELETE FROM users WHERE user_id = :user_id",
+    user_info="SELECT user_id, username, full_name FROM users WHERE user_id = :user_id",
+    extended_user_info="""
+        SELECT user_id, about, registered, image FROM users
+        LEFT JOIN user_data USING (user_id)
+        WHERE user_id = :user_id
+    """,
+    set_user_image="""
+        INSERT INTO user_data (user_id, image)
+        VALUES (:user_id, :image)
+        ON CONFLICT (user_id) DO UPDATE
+        SET image = :image
+    """,
+    # Update job
+    users_since="""
+        SELECT user_id FROM users
+        WHERE registered >= :date::timestamp
+        ORDER BY registered ASC
+    """,
+    users_of_shard="""
+        SELECT user_id FROM users
+        WHERE MOD(user_id, :shards::INTEGER) = :shard::INTEGER
+        ORDER BY user_id ASC
+    """,
+    database_time="SELECT LOCALTIMESTAMP",
+    last_update="SELECT MAX(started) FROM update_runs",
+    record_update="INSERT INTO update_runs (started, mode) VALUES (:started, :mode)",
+    bump_recommendation_version="UPDATE recommendation_version SET version = version + 1",
+    rating_changes="""
+        SELECT DISTINCT user_id, item_id FROM {dataset}_rating_changes
+        WHERE changed > :since AND changed <= :until
+    """,
+)
+
+# Reads of the published recommendations, which may lag behind on a
+# read replica. Everything else, including reads of the ratings and the
+# user accounts, runs on the primary to see the user's own writes
+REPLICA_READS = {
+    "recommendation_version",
+    "popular_ids",
+    "item_based_ids",
+    "user_based_ids",
+    "popular_seed_ids",
+    "seed_ids",
+}
+
+# Bound parameters, but not casts like ::text
+_PARAMETER = re.compile(r"(?<!:):(\w+)")
+
+
+def _compile(sql):
+    """Replace named parameters by positional ones, return the SQL and the names"""
+    names = []
+
+    def placeholder(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    return _PARAMETER.sub(placeholder, sql), names
+
+
+def _register(statements):
+    """Generate the statements of all datasets"""
+    registry = dict()
+    for name, sql in statements.items():
+        if "{dataset}" in sql:
+            for dataset, item_type in DATASETS.items():
+                sql_dataset = sql.format(dataset=dataset, item_type=item_type)
+                registry[f"{name}_{dataset}"] = _compile(sql_dataset)
+        else:
+            registry[name] = _compile(sql)
+    return registry
+
+
+REGISTRY = _register(STATEMENTS)
+
+
+class Row:
+    """
+    Single result row with the columns as slotted attributes
+
+    Columns can be read as attributes or by name like a dict. Rows of
+    each set of columns share one class, see row_type.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, values):
+        for column, value in zip(self.__slots__, values):
+            setattr(self, column, value)
+
+    def __getitem__(self, column):
+        if column not in self.__slots__:
+            raise KeyError(column)
+        return getattr(self, column)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __repr__(self):
+        columns = ", ".join(f"{column}={value!r}" for column, value in self.items())
+        return f"Row({columns})"
+
+    def get(self, column, default=None):
+        return getattr(self, column) if column in self.__slots__ else default
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, column) for column in self.__slots__]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+_row_types = dict()
+
+
+def row_type(columns):
+    """Row class of a set of columns, created once per set"""
+    columns = tuple(columns)
+    cls = _row_types.get(columns)
+    if cls is None:
+        cls = type("Row", (Row,), dict(__slots__=columns))
+        _row_types[columns] = cls
+    return cls
+
+
+def _engine(name, engine=None):
+    """Engine to run a statement on, a read replica if it allows it"""
+    if engine is not None:
+        return engine
+    if name in REPLICA_READS:
+        return Connection().get_reader()
+    return Connection().get()
+
+
+def execute(connection, name, dataset=None, **params):
+    """
+    Execute a registered statement, preparing it on first use
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection
+        Connection to execute the statement on
+
+    name : str
+        Name of the statement
+
+    dataset : {"books", "mangas"}, optional
+        Dataset of statements that refer to a dataset
+
+    **params
+        Values of the parameters of the statement
+
+    Returns
+    -------
+    result : sqlalchemy.engine.CursorResult
+        Result of the statement
+    """
+    key = name if dataset is None else f"{name}_{dataset}"
+    sql, names = REGISTRY[key]
+
+    # Prepared statements belong to the connection and survive its reuse
+    prepared = connection.info.setdefault("prepared_statements", set())
+    if key not in prepared:
+        connection.exec_driver_sql(f"PREPARE {key} AS {sql}")
+        prepared.add(key)
+
+    if not names:
+        return connection.exec_driver_sql(f"EXECUTE {key}")
+    arguments = ", ".join(f"%({name})s" for name in names)
+    return connection.exec_driver_sql(
+        f"EXECUTE {key} ({arguments})", {name: params[name] for name in names}
+    )
+
+
+def read_frame(name, dataset=None, engine=None, **params):
+    """
+    Execute a registered statement and return the rows as a DataFrame
+
+    Parameters
+    ----------
+    name : str
+        Name of the statement
+
+    dataset : {"books", "mangas"}, optional
+        Dataset of statements that refer to a dataset
+
+    engine : sqlalchemy.engine.Engine, optional
+        Engine to run the statement on instead of the one it is routed
+        to, e.g. the read replica a cached read was validated on
+
+    **params
+        Values of the parameters of the statement
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Rows of the result
+    """
+    with _engine(name, engine).connect() as connection:
+        result = execute(connection, name, dataset, **params)
+        df = pd.DataFrame(result.all(), columns=list(result.keys()))
+    return df
+
+
+def read_row(name, dataset=None, engine=None, **params):
+    """
+    Execute a registered statement and return the first row
+
+    Parameters
+    ----------
+    name : str
+        Name of the statement
+
+    dataset : {"books", "mangas"}, optional
+        Dataset of statements that refer to a dataset
+
+    engine : sqlalchemy.engine.Engine, optional
+        Engine to run the statement on, see read_frame
+
+    **params
+        Values of the parameters of the statement
+
+    Returns
+    -------
+    row : Row or None
+        First row of the result, None if there are no rows
+    """
+    with _engine(name, engine).connect() as connection:
+        result = execute(connection, name, dataset, **params)
+        values = result.fetchone()
+        row = None if values is None else row_type(result.keys())(values)
+    return row
+
+
+def read_scalar(name, dataset=None, engine=None, **params):
+    """
+    Execute a registered statement and return the first value
+
+    Parameters
+    ----------
+    name : str
+        Name of the statement
+
+    dataset : {"books", "mangas"}, optional
+        Dataset of statements that refer to a dataset
+
+    engine : sqlalchemy.engine.Engine, optional
+        Engine to run the statement on, see read_frame
+
+    **params
+        Values of the parameters of the statement
+
+    Returns
+    -------
+    value : object
+        First column of the first row, None if there are no rows
+    """
+    with _engine(name, engine).connect() as connection:
+        value = execute(connection, name, dataset, **params).scalar()
+    return value
@@ -29,7 +29,7 @@ full_name = user_data["full_name"]
 registered = user_data.get("registered")
 
 # Get number of ratings
-items_rated = query.get_num_ratings(user_id)
+items_rated = authentication.get_rated_items().count()
 
 if isinstance(registered, datetime):
     days_registered = (datetime.now().date() - registered.date()).days
@@ -1,5 +1,9 @@
 -- Drop dynamic tables
 
+DROP TABLE IF EXISTS books_rating_changes CASCADE;
+DROP TABLE IF EXISTS mangas_rating_changes CASCADE;
+DROP TABLE IF EXISTS update_runs CASCADE;
+DROP TABLE IF EXISTS recommendation_version CASCADE;
 DROP TABLE IF EXISTS books_ratings CASCADE;
 DROP TABLE IF EXISTS mangas_ratings CASCADE;
 DROP TABLE IF EXISTS user_data CASCADE;
@@ -40,6 +44,39 @@ CREATE TABLE mangas_ratings (
   FOREIGN KEY (item_id) REFERENCES mangas(item_id)
 );
 
+-- Rating change log (dynamic)
+
+CREATE TABLE books_rating_changes (
+  user_id INTEGER NOT NULL,
+  item_id VARCHAR(20) NOT NULL,
+  changed TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE mangas_rating_changes (
+  user_id INTEGER NOT NULL,
+  item_id INTEGER NOT NULL,
+  changed TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX books_rating_changes_changed ON books_rating_changes (changed);
+CREATE INDEX mangas_rating_changes_changed ON mangas_rating_changes (changed);
+
+-- Successful recommendation updates (dynamic)
+
+CREATE TABLE update_runs (
+  started TIMESTAMP NOT NULL,
+  finished TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  mode VARCHAR(20) NOT NULL
+);
+
+-- Version of the published recommendations (semi-dynamic)
+
+CREATE TABLE recommendation_version (
+  version INTEGER NOT NULL
+);
+
+INSERT INTO recommendation_version (version) VALUES (0);
+
 -- Copy data from original tables
 
 INSERT INTO users (
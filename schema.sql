@@ -1,3 +1,7 @@
+DROP TABLE IF EXISTS books_rating_changes CASCADE;
+DROP TABLE IF EXISTS mangas_rating_changes CASCADE;
+DROP TABLE IF EXISTS update_runs CASCADE;
+DROP TABLE IF EXISTS recommendation_version CASCADE;
 DROP TABLE IF EXISTS books_ratings CASCADE;
 DROP TABLE IF EXISTS mangas_ratings CASCADE;
 DROP TABLE IF EXISTS books_ratings_original CASCADE;
@@ -9,6 +13,8 @@ DROP TABLE IF EXISTS books_item_based CASCADE;
 DROP TABLE IF EXISTS mangas_item_based CASCADE;
 DROP TABLE IF EXISTS books_user_based CASCADE;
 DROP TABLE IF EXISTS mangas_user_based CASCADE;
+DROP TABLE IF EXISTS books_seeds CASCADE;
+DROP TABLE IF EXISTS mangas_seeds CASCADE;
 
 DROP TABLE IF EXISTS books CASCADE;
 DROP TABLE IF EXISTS mangas CASCADE;
@@ -70,3 +76,36 @@ CREATE TABLE mangas_ratings (
   FOREIGN KEY (user_id) REFERENCES users(user_id),
   FOREIGN KEY (item_id) REFERENCES mangas(item_id)
 );
+
+-- Rating change log (dynamic)
+
+CREATE TABLE books_rating_changes (
+  user_id INTEGER NOT NULL,
+  item_id VARCHAR(20) NOT NULL,
+  changed TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE mangas_rating_changes (
+  user_id INTEGER NOT NULL,
+  item_id INTEGER NOT NULL,
+  changed TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX books_rating_changes_changed ON books_rating_changes (changed);
+CREATE INDEX mangas_rating_changes_changed ON mangas_rating_changes (changed);
+
+-- Successful recommendation updates (dynamic)
+
+CREATE TABLE update_runs (
+  started TIMESTAMP NOT NULL,
+  finished TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  mode VARCHAR(20) NOT NULL
+);
+
+-- Version of the published recommendations (semi-dynamic)
+
+CREATE TABLE recommendation_version (
+  version INTEGER NOT NULL
+);
+
+INSERT INTO recommendation_version (version) VALUES (0);
@@ -2,31 +2,383 @@
 Update the dynamic data with the latest recommendations
 """
 
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
 from dotenv import load_dotenv
+from sqlalchemy.sql import text
+
+from mangoleaf import Connection, artifacts, query, recommend
+from mangoleaf.publish import long_format, publish_query, publish_table
+
+DATASETS = ["books", "mangas"]
+ITEM_ID_TYPES = dict(books="TEXT", mangas="BIGINT")
+NEIGHBOR_KEY = ["source_id", "rank"]
+USER_ID_TYPE = "BIGINT"
+SEEDS = 10
+
+
+def _as_model(model):
+    """Load a stored model if given by its path"""
+    if isinstance(model, (str, Path)):
+        return artifacts.Model.load(model)
+    return model
+
+
+def neighbor_types(dataset, source_type):
+    """SQL types of a table of neighbor lists, whatever the DataFrame infers"""
+    return dict(source_id=source_type, rank="BIGINT", item_id=ITEM_ID_TYPES[dataset])
+
+
+def publish_popularity(dataset, n, count_threshold):
+    df = recommend.popularity(dataset, n, count_threshold)
+    column_types = dict(id="BIGINT", item_id=ITEM_ID_TYPES[dataset])
+    publish_table(df.reset_index(names="id"), f"{dataset}_popular", "id", column_types)
+
+
+def fit_model(dataset, k, block_size):
+    model = artifacts.load_or_fit(dataset, k, block_size)
+    return artifacts.model_path(model.dataset, model.checksum, model.k)
+
+
+def publish_item_based(model, n):
+    model = _as_model(model)
+    df = recommend.item_based(model.dataset, n, model=model)
+    publish_table(
+        long_format(df, "item_id"),
+        f"{model.dataset}_item_based",
+        NEIGHBOR_KEY,
+        neighbor_types(model.dataset, ITEM_ID_TYPES[model.dataset]),
+    )
+    publish_seeds(model.dataset)
+
+
+def _seeds_query(dataset, n, where="TRUE"):
+    """Query of the highest rated items of the users that match a condition"""
+    return f"""
+    SELECT user_id, rank, item_id FROM (
+        SELECT r.user_id, r.item_id, ROW_NUMBER() OVER (
+            PARTITION BY r.user_id ORDER BY r.rating DESC, RANDOM()
+        ) - 1 AS rank
+        FROM {dataset}_ratings r
+        WHERE {where} AND EXISTS (
+            SELECT 1 FROM {dataset}_item_based b WHERE b.source_id = r.item_id
+        )
+    ) s
+    WHERE rank < {n}
+    """
+
+
+def publish_seeds(dataset, n=SEEDS):
+    """
+    Publish the highest rated items of each user that have recommendations
+
+    The seeds are the reference items of the item-based recommendations
+    of a user, so they must be published after the item-based table.
+    Ties in the rating are broken at random.
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    n : int, optional
+        Number of seeds per user. Default is SEEDS
+    """
+    publish_query(_seeds_query(dataset, n), f"{dataset}_seeds", ["user_id", "rank"])
+
+
+def upsert_seeds(dataset, users, n=SEEDS):
+    """
+    Replace the seeds of the given users, see publish_seeds
+
+    Parameters
+    ----------
+    dataset : {"books", "mangas"}
+        Name of the dataset
+
+    users : list
+        user_ids to replace the seeds of. Seeds of users without ratings
+        are deleted
+
+    n : int, optional
+        Number of seeds per user. Default is SEEDS
+    """
+    select_query = _seeds_query(dataset, n, "r.user_id = ANY(:ids)")
+    db_engine = Connection().get()
+    with db_engine.begin() as connection:
+        query_str = f"DELETE FROM {dataset}_seeds WHERE user_id = ANY(:ids)"
+        connection.execute(text(query_str), dict(ids=list(users)))
+        query_str = f"INSERT INTO {dataset}_seeds (user_id, rank, item_id) {select_query}"
+        connection.execute(text(query_str), dict(ids=list(users)))
+
+
+def publish_user_based(model, users, n, block_size):
+    model = _as_model(model)
+    df = recommend.user_based(model.dataset, users, n, block_size=block_size, model=model)
+    publish_table(
+        long_format(df, "user_id"),
+        f"{model.dataset}_user_based",
+        NEIGHBOR_KEY,
+        neighbor_types(model.dataset, USER_ID_TYPE),
+    )
+
+
+def update_database(users, n=40, count_threshold=50, block_size=1024, workers=1):
+    started = query.database_time()
+
+    if workers > 1:
+        _update_parallel(users, n, count_threshold, block_size, workers)
+    else:
+        for dataset in DATASETS:
+            print(f"Generate recommendations for {dataset}")
+            publish_popularity(dataset, n, count_threshold)
+
+            # One fitted model is shared by the k-NN recommenders
+            model = artifacts.load_or_fit(dataset, max(n, 40), block_size)
+            publish_item_based(model, n)
+            publish_user_based(model, users, n, block_size)
+
+    query.bump_recommendation_version()
+    query.record_update(started, "full")
+
+
+def _update_parallel(users, n, count_threshold, block_size, workers):
+    """
+    Run the update stages of all datasets in a process pool
 
-from mangoleaf import Connection, query, recommend
+    Popularity and the model fits start right away. The k-NN stages of a
+    dataset start as soon as its model is stored and load it from disk.
+    """
+    print(f"Generate recommendations with {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        stages = [
+            executor.submit(publish_popularity, dataset, n, count_threshold)
+            for dataset in DATASETS
+        ]
+        fits = [
+            executor.submit(fit_model, dataset, max(n, 40), block_size) for dataset in DATASETS
+        ]
+        for fit in as_completed(fits):
+            path = fit.result()
+            stages.append(executor.submit(publish_item_based, path, n))
+            stages.append(executor.submit(publish_user_based, path, users, n, block_size))
 
+        # Raise the first error of any stage
+        for stage in as_completed(stages):
+            stage.result()
 
-def update_database(users, n=40, count_threshold=50):
+
+def upsert(df, table, key, ids):
+    """
+    Replace the rows of the given ids in a recommendation table
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        New rows of the table
+
+    table : str
+        Name of the table
+
+    key : str
+        Column that identifies the rows
+
+    ids : list
+        Values of the key column to replace. Rows of ids that are not in
+        the DataFrame are deleted
+    """
     db_engine = Connection().get()
-    update_params = dict(con=db_engine, if_exists="replace")
+    with db_engine.begin() as connection:
+        query_str = f"DELETE FROM {table} WHERE {key} = ANY(:ids)"
+        connection.execute(text(query_str), dict(ids=list(ids)))
+        df.to_sql(table, connection, if_exists="append", index=False)
+
+
+def update_incremental(n=40, count_threshold=50, block_size=1024, workers=1):
+    """
+    Update only the recommendations affected by new ratings
+
+    Uses the rating change log since the last successful update. Only
+    the neighbor lists of items with new ratings and the personal
+    recommendations of users with new ratings are recomputed.
+
+    Returns
+    -------
+    success : bool
+        False if there was no previous update to continue from
+    """
+    since = query.last_update()
+    if since is None:
+        print("No previous update to continue from")
+        return False
+    started = query.database_time()
+
+    args = (since, started, n, count_threshold, block_size)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            stages = [executor.submit(_update_dataset, dataset, *args) for dataset in DATASETS]
+            for stage in as_completed(stages):
+                stage.result()
+    else:
+        for dataset in DATASETS:
+            _update_dataset(dataset, *args)
+
+    query.bump_recommendation_version()
+    query.record_update(started, "incremental")
+    return True
+
+
+def _update_dataset(dataset, since, started, n, count_threshold, block_size):
+    """Incremental update of one dataset, see update_incremental"""
+    print(f"Update recommendations for {dataset}")
+    publish_popularity(dataset, n, count_threshold)
+
+    users, items = query.list_rating_changes(dataset, since, started)
+    if not users:
+        print(f"No rating changes for {dataset}")
+        return
+    print(f"Ratings of {len(users)} users and {len(items)} {dataset} changed")
+
+    model = artifacts.load_or_update(dataset, users, items, max(n, 40), block_size)
+
+    # Items and users without ratings left are not in the model anymore,
+    # so upsert deletes their rows. Items that lost a neighbor to them
+    # have new neighbors as well
+    items = list(dict.fromkeys(items + list(model.recomputed_items)))
+    df = recommend.item_based(dataset, n, model=model, items=items)
+    upsert(long_format(df, "item_id"), f"{dataset}_item_based", "source_id", items)
+    upsert_seeds(dataset, users)
+
+    df = recommend.user_based(dataset, users, n, block_size=block_size, model=model)
+    upsert(long_format(df, "user_id"), f"{dataset}_user_based", "source_id", users)
+
 
-    for dataset in ["books", "mangas"]:
-        print(f"Generate recommendations for {dataset}")
+def shard_table(dataset, shard, shards):
+    return f"{dataset}_user_based_shard_{shard}_of_{shards}"
 
-        df = recommend.popularity(dataset, n, count_threshold)
-        df.to_sql(f"{dataset}_popular", **update_params, index_label="id")
 
-        df = recommend.item_based(dataset, n)
-        df.to_sql(f"{dataset}_item_based", **update_params, index=False)
+def update_shard(shard, shards, n=40, block_size=1024):
+    """
+    Compute the personal recommendations of one shard of all users
 
-        df = recommend.user_based(dataset, users, n)
-        df.to_sql(f"{dataset}_user_based", **update_params, index=False)
+    The users are split by user_id modulo the number of shards. Each
+    shard is written to its own table, so shards can run on different
+    machines at the same time. All shards score against the stored
+    model of each dataset, which must be shared through the artifact
+    directory (see artifacts.artifact_dir). Run merge_shards afterwards
+    to publish the shards as the user-based table.
+
+    Parameters
+    ----------
+    shard : int
+        Index of the shard, from 0 to shards - 1
+
+    shards : int
+        Number of shards
+
+    n : int, optional
+        Number of items to recommend. Default is 40
+
+    block_size : int, optional
+        Number of users to score at once. Default is 1024
+    """
+    users = query.list_users(shard, shards)
+    print(f"Generate recommendations for shard {shard} of {shards} ({len(users)} users)")
+
+    for dataset in DATASETS:
+        model = artifacts.load_latest(dataset, max(n, 40))
+        if model is None:
+            model = artifacts.load_or_fit(dataset, max(n, 40), block_size)
+        df = recommend.user_based(dataset, users, n, block_size=block_size, model=model)
+        publish_table(
+            long_format(df, "user_id"),
+            shard_table(dataset, shard, shards),
+            NEIGHBOR_KEY,
+            neighbor_types(dataset, USER_ID_TYPE),
+        )
+
+
+def merge_shards(shards):
+    """
+    Publish the shards of update_shard as the user-based tables
+
+    The user-based table of a dataset is only replaced if all of its
+    shards exist. The shard tables are dropped afterwards.
+
+    Parameters
+    ----------
+    shards : int
+        Number of shards
+    """
+    db_engine = Connection().get()
+    for dataset in DATASETS:
+        tables = [shard_table(dataset, shard, shards) for shard in range(shards)]
+        with db_engine.connect() as connection:
+            query_str = "SELECT t FROM unnest(:tables) t WHERE to_regclass(t) IS NULL"
+            missing = connection.execute(text(query_str), dict(tables=tables)).scalars().all()
+        if missing:
+            raise RuntimeError(f"Missing shards of {dataset}: {', '.join(missing)}")
+
+        # Shards may infer different column types, cast them to the item_id type
+        columns = (
+            f"source_id::{USER_ID_TYPE} AS source_id, rank::BIGINT AS rank, "
+            f"item_id::{ITEM_ID_TYPES[dataset]} AS item_id"
+        )
+        select_query = " UNION ALL ".join(f"SELECT {columns} FROM {table}" for table in tables)
+        print(f"Merge {shards} shards of {dataset}")
+        publish_query(select_query, f"{dataset}_user_based", NEIGHBOR_KEY)
+
+        with db_engine.begin() as connection:
+            for table in tables:
+                connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
+
+    query.bump_recommendation_version()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only update recommendations affected by ratings since the last update",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to run datasets and stages in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="I/N",
+        help="Only compute the personal recommendations of shard I of N of all users",
+    )
+    parser.add_argument(
+        "--merge",
+        metavar="N",
+        type=int,
+        help="Publish the personal recommendations of N completed shards",
+    )
+    args = parser.parse_args()
+
     load_dotenv(".streamlit/secrets.toml")
 
+    if args.shard is not None:
+        shard, shards = map(int, args.shard.split("/"))
+        if not 0 <= shard < shards:
+            parser.error(f"Invalid shard: {args.shard}")
+        update_shard(shard, shards, 40)
+        raise SystemExit(0)
+
+    if args.merge is not None:
+        merge_shards(args.merge)
+        raise SystemExit(0)
+
+    if args.incremental and update_incremental(40, 50, workers=args.workers):
+        raise SystemExit(0)
+
     # Selected users for user-based recommendations
     users = [
         # Manga example users
@@ -41,4 +393,4 @@ if __name__ == "__main__":
     new_users = query.list_users_since("2024-08-01")
     users += new_users
 
-    update_database(users, 40, 50)
+    update_database(users, 40, 50, workers=args.workers)